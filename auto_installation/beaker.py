@@ -1,43 +1,204 @@
 import attr
 import json
+import redis
+import shlex
 import subprocess
 import time
 import logging
-from threading import Thread
-from .cobbler import Cobbler
-from .utils import ReserveUserWrongException, init_redis
+from multiprocessing.pool import ThreadPool
+from threading import Thread, Lock, Event
+from Queue import Queue, Empty
+from .utils import ReserveUserWrongException, init_redis, ttl_cache
 
 log = logging.getLogger("Beaker")
 
 
+# give up on an installation which didn't call back within 20min
+INSTALL_TIMEOUT = 1200
+# how long watch waits for the dispatcher to subscribe a channel
+SUBSCRIBE_TIMEOUT = 10
+
+# a bkr command still running after this is killed
+BKR_TIMEOUT = 180
+# bkr commands which are safe to run again when they fail
+BKR_RETRY_CMDS = ('clear_netboot', 'power_on', 'power_off', 'reboot', 'status')
+BKR_RETRIES = 2
+# system-status of a host is reused within a run for this long
+BKR_STATUS_TTL = 60
+
+
+class BkrCommandTimeout(Exception):
+    pass
+
+
+def _run_bkr(cmd, timeout=BKR_TIMEOUT):
+    """Run a bkr command without a shell, kill it after `timeout`
+
+    Returns (return code, output).
+    """
+    proc = subprocess.Popen(
+        shlex.split(cmd), stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    ret = []
+    reader = Thread(target=lambda: ret.append(proc.communicate()[0]))
+    reader.setDaemon(True)
+    reader.start()
+    reader.join(timeout)
+    if reader.is_alive():
+        proc.kill()
+        reader.join()
+        raise BkrCommandTimeout("{} didn't finish within {}s".format(
+            cmd, timeout))
+    return proc.returncode, ret[0]
+
+
+@ttl_cache(BKR_STATUS_TTL)
+def _system_status(cmd):
+    rc, output = _run_bkr(cmd)
+    if rc:
+        raise subprocess.CalledProcessError(rc, cmd, output)
+    return output
+
+
+class BeakerExecutor(object):
+    """Runs Beaker operations of many hosts at the same time
+
+    Every call returns an AsyncResult, `get(timeout)` on it gives the
+    result of the operation or raises its exception.
+    """
+
+    def __init__(self, workers=8):
+        self._workers = workers
+        self._pool = None
+        self._lock = Lock()
+
+    @property
+    def pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self._workers)
+            return self._pool
+
+    def submit(self, func, *args):
+        return self.pool.apply_async(func, args)
+
+    def run_all(self, op, bkr_names, **kwargs):
+        """Start `op` (e.g. 'reserve') on every host, {bkr_name: result}"""
+        bp = Beaker(**kwargs)
+        return dict((m, self.submit(getattr(bp, op), m)) for m in bkr_names)
+
+
 @attr.s
-class WatchInstallation(object):
-    ch_name = attr.ib()
-    p = attr.ib()
-    redis_conn = attr.ib(default=init_redis())
+class InstallEventDispatcher(object):
+    """One redis subscriber multiplexing every machine channel
+
+    Jobs block on `wait` and are woken up as soon as a message is
+    published on their channel, instead of polling the pubsub themselves.
+    The pubsub isn't thread-safe, only the listener thread uses it: the
+    (un)subscribe requests are queued for it and a message on
+    `ctrl_channel` wakes it up to handle them.
+    """
+    redis_conn = attr.ib(default=attr.Factory(init_redis))
+    poll_timeout = attr.ib(default=1.0)
+    ctrl_channel = attr.ib(default="zoidberg-dispatcher")
+    _pubsub = attr.ib(default=None, init=False)
+    _thread = attr.ib(default=None, init=False)
+    _queues = attr.ib(default=attr.Factory(dict), init=False)
+    _requests = attr.ib(default=attr.Factory(Queue), init=False)
+    _lock = attr.ib(default=attr.Factory(Lock), init=False)
+
+    def start(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = Thread(target=self._listen, name="inst-dispatcher")
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def _subscribe_all(self):
+        if self._pubsub is not None:
+            self._pubsub.close()
+        self._pubsub = self.redis_conn.pubsub(ignore_subscribe_messages=True)
+        with self._lock:
+            channels = self._queues.keys()
+        self._pubsub.subscribe(self.ctrl_channel, *channels)
 
-    def watch(self):
-        now = time.time()
+    def _handle_requests(self):
         while True:
-            msg = self.p.get_message(ignore_subscribe_messages=True)
-            log.info("waiting for installation message")
-            if msg:
-                log.info("get message from channel %s: %s", self.ch_name, msg)
-                with Cobbler() as cb:
-                    log.info("remove system %s from cobbler", self.ch_name)
-                    cb.remove_system(self.ch_name)
-                self.redis_conn.publish(self.ch_name, msg['data'])
-                break
-            elif (time.time() - now > 1200):
-                log.error("provision job is time-out after 20min")
-                self.redis_conn.publish(self.ch_name, 'fail')
-                break
-            time.sleep(10)
-
-
-def inst_watcher(ch_name, p):
-    ins = WatchInstallation(ch_name, p)
-    return Thread(target=ins.watch)
+            try:
+                action, ch_name, done = self._requests.get_nowait()
+            except Empty:
+                return
+            try:
+                getattr(self._pubsub, action)(ch_name)
+            finally:
+                # on a connection error the channel is subscribed again
+                # along with the others
+                done.set()
+
+    def _listen(self):
+        connected = False
+        while True:
+            try:
+                if not connected:
+                    self._subscribe_all()
+                    connected = True
+                self._handle_requests()
+                msg = self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=self.poll_timeout)
+            except redis.ConnectionError as e:
+                log.error("lost redis connection: %s, resubscribing", e)
+                connected = False
+                time.sleep(self.poll_timeout)
+                continue
+
+            if not msg or msg['type'] != 'message':
+                continue
+            if msg['channel'] == self.ctrl_channel:
+                # only sent to wake us up, the requests are handled above
+                continue
+            log.info("get message from channel %s: %s", msg['channel'],
+                     msg['data'])
+            q = self._queues.get(msg['channel'])
+            if q:
+                q.put(msg['data'])
+
+    def _request(self, action, ch_name):
+        done = Event()
+        self._requests.put((action, ch_name, done))
+        self.redis_conn.publish(self.ctrl_channel, action)
+        return done
+
+    def watch(self, ch_name):
+        """Subscribe `ch_name` and drop anything left from a previous run"""
+        self.start()
+        with self._lock:
+            q = self._queues.get(ch_name)
+            subscribe = q is None
+            if subscribe:
+                q = self._queues[ch_name] = Queue()
+        while not q.empty():
+            q.get_nowait()
+        if subscribe:
+            # the host is rebooted once we return, be subscribed by then
+            self._request('subscribe', ch_name).wait(SUBSCRIBE_TIMEOUT)
+
+    def unwatch(self, ch_name):
+        with self._lock:
+            if self._queues.pop(ch_name, None) is None:
+                return
+        self._request('unsubscribe', ch_name)
+
+    def wait(self, ch_name, timeout=None):
+        """Block until a message arrives on `ch_name`, None on time-out"""
+        if ch_name not in self._queues:
+            self.watch(ch_name)
+        try:
+            return self._queues[ch_name].get(timeout=timeout)
+        except Empty:
+            return None
+
+
+inst_dispatcher = InstallEventDispatcher()
 
 
 @attr.s
@@ -73,12 +234,26 @@ class Beaker(object):
 
     def _exec_cmd(self, cmd, bkr_name, args, output=False):
         _cmd = self.CMDs[cmd].format(**args)
-        if not output:
-            ret = subprocess.call(_cmd, shell=True)
-            return ret
-        else:
-            ret = subprocess.check_output(_cmd, shell=True)
-            return ret
+        retries = BKR_RETRIES if cmd in BKR_RETRY_CMDS else 0
+        for attempt in range(retries + 1):
+            if attempt:
+                # back off 2s, 4s, ...
+                time.sleep(2**attempt)
+            try:
+                if output:
+                    return _system_status(_cmd)
+                rc, out = _run_bkr(_cmd)
+            except (BkrCommandTimeout, subprocess.CalledProcessError) as e:
+                log.warning("%s on %s failed: %s", cmd, bkr_name, e)
+                if attempt == retries:
+                    raise
+                continue
+            if rc == 0 or attempt == retries:
+                if rc:
+                    log.warning("%s on %s returned %s: %s", cmd, bkr_name, rc,
+                                out.strip())
+                return rc
+            log.warning("%s on %s returned %s, retrying", cmd, bkr_name, rc)
 
     def power_on(self, bkr_name):
         """pass"""
@@ -106,10 +281,12 @@ class Beaker(object):
 
     def reserve(self, bkr_name):
         """pass"""
+        _system_status.cache_clear()
         return self._exec_cmd('reserve', bkr_name, dict(bkr_name=bkr_name))
 
     def release(self, bkr_name):
         """pass"""
+        _system_status.cache_clear()
         return self._exec_cmd('release', bkr_name, dict(bkr_name=bkr_name))
 
     def status(self, bkr_name):
@@ -131,6 +308,9 @@ class Beaker(object):
             return False
 
 
+beaker_executor = BeakerExecutor()
+
+
 if __name__ == '__main__':
     bk = Beaker()
 
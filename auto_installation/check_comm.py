@@ -1,15 +1,53 @@
 import logging
-from fabric.api import settings, run, get, put
-from fabric.exceptions import NetworkError, CommandTimeout
 import re
-from utils import get_checkpoint_cases_map
+import uuid
+from multiprocessing.pool import ThreadPool
+from utils import get_checkpoint_cases_map, results_logs
+from ssh_pool import ssh_pool, CommandTimeout, RemoteResult
 
 log = logging.getLogger('bender')
 
+BATCH_BEGIN = "__ZB_{token}_BEGIN_{index}__"
+BATCH_END = "__ZB_{token}_END_{index}_$?__"
+# exit code of coreutils `timeout` when the command was killed
+BATCH_TIMEOUT_CODE = 124
+
+
+def gen_batch_script(cmds, token, timeout):
+    """Join cmds into one script framing each output with its exit code"""
+    lines = []
+    for index, cmd in enumerate(cmds):
+        lines.append("echo {}".format(
+            BATCH_BEGIN.format(token=token, index=index)))
+        lines.append("timeout --foreground {} /bin/bash -c '{}'".format(
+            timeout, cmd.replace("'", "'\\''")))
+        lines.append("echo {}".format(
+            BATCH_END.format(token=token, index=index)))
+    return "\n".join(lines)
+
+
+def parse_batch_output(output, token, count):
+    """Split the output of gen_batch_script into {index: RemoteResult}"""
+    pattern = re.compile(
+        r'__ZB_{0}_BEGIN_(\d+)__\r?\n?(.*?)__ZB_{0}_END_\1_(\d+)__'.format(
+            token), re.S)
+    rets = {}
+    for m in pattern.finditer(output):
+        index = int(m.group(1))
+        if index < count:
+            rets[index] = RemoteResult(m.group(2).strip(), int(m.group(3)))
+    return rets
+
 
 class CheckYoo(object):
     """"""
 
+    # checkpoints which only read the host state, they run concurrently
+    readonly_checkpoints = ()
+    # checkpoints which must run after all the others, in this order
+    final_checkpoints = ("roll_back_check", )
+    checkpoint_workers = 4
+
     def __init__(self):
         self._host_string = None
         self._host_user = None
@@ -59,49 +97,93 @@ class CheckYoo(object):
         self._ksfile = val
 
     def get_remote_file(self, remote_path, local_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = get(remote_path, local_path)
-            if not ret.succeeded:
-                raise ValueError("Can't get {} from remote server:{}.".format(
-                    remote_path, self.host_string))
+        try:
+            ssh_pool.get(self.host_string, self.host_user, self.host_pass,
+                         remote_path, local_path, attempts=120)
+        except Exception as e:
+            raise ValueError("Can't get {} from remote server:{}, {}.".format(
+                remote_path, self.host_string, e))
 
     def put_remote_file(self, local_path, remote_path):
-        with settings(
-                host_string=self.host_string,
-                user=self.host_user,
-                password=self.host_pass,
-                disable_known_hosts=True,
-                connection_attempts=120):
-            ret = put(local_path, remote_path)
-            if not ret.succeeded:
-                raise ValueError("Can't put {} to remote server:{}.".format(
-                    local_path, self.host_string))
+        try:
+            ssh_pool.put(self.host_string, self.host_user, self.host_pass,
+                         local_path, remote_path, attempts=120)
+        except Exception as e:
+            raise ValueError("Can't put {} to remote server:{}, {}.".format(
+                local_path, self.host_string, e))
+
+    def reset_connection(self):
+        """Drop the pooled connection, the host is (re)booting"""
+        ssh_pool.drop(self.host_string)
 
     def run_cmd(self, cmd, timeout=60):
         ret = None
         try:
-            with settings(
-                    host_string=self.host_string,
-                    user=self.host_user,
-                    password=self.host_pass,
-                    disable_known_hosts=True,
-                    connection_attempts=60):
-                ret = run(cmd, quiet=True, timeout=timeout)
-                if ret.succeeded:
-                    log.info('Run cmd "%s" succeeded', cmd)
-                    return True, ret
-                else:
-                    log.error('Run cmd "%s" failed', cmd)
-                    return False, ret
+            ret = ssh_pool.run(
+                self.host_string,
+                self.host_user,
+                self.host_pass,
+                cmd,
+                timeout=timeout,
+                attempts=60)
+            if ret.succeeded:
+                log.info('Run cmd "%s" succeeded', cmd)
+                return True, ret
+            else:
+                log.error('Run cmd "%s" failed', cmd)
+                return False, ret
         except Exception as e:
             log.error('Run cmd "%s" failed with exception "%s"', cmd, e)
             return False, e
 
+    def run_cmds(self, cmds, timeout=60):
+        """Run several commands within a single remote exec
+
+        `cmds` is a list of commands or a {name: command} dict, each command
+        gets its own `timeout`. Returns {name: (succeeded, output)} with the
+        same values as run_cmd.
+        """
+        if isinstance(cmds, dict):
+            names, cmd_list = zip(*cmds.items()) if cmds else ((), ())
+        else:
+            cmd_list = list(cmds)
+            names = cmd_list
+        if not cmd_list:
+            return {}
+
+        token = uuid.uuid4().hex[:8]
+        script = gen_batch_script(cmd_list, token, timeout)
+        log.info('Run cmds %s in batch %s', list(cmd_list), token)
+        try:
+            output = ssh_pool.run(
+                self.host_string,
+                self.host_user,
+                self.host_pass,
+                script,
+                timeout=timeout * len(cmd_list) + 30,
+                attempts=60)
+        except Exception as e:
+            log.error('Run batch %s failed with exception "%s"', token, e)
+            return dict((name, (False, e)) for name in names)
+
+        outputs = parse_batch_output(output, token, len(cmd_list))
+        rets = {}
+        for index, name in enumerate(names):
+            ret = outputs.get(index)
+            if ret is None:
+                log.error('Run cmd "%s" failed, no output in batch', name)
+                rets[name] = (False, None)
+            elif ret.return_code == BATCH_TIMEOUT_CODE:
+                log.error('Run cmd "%s" timed out', name)
+                rets[name] = (False, CommandTimeout(timeout))
+            elif ret.succeeded:
+                log.info('Run cmd "%s" succeeded', name)
+                rets[name] = (True, ret)
+            else:
+                log.error('Run cmd "%s" failed', name)
+                rets[name] = (False, ret)
+        return rets
+
     def check_strs_in_file(self, fp, strs, timeout):
         log.info("start to check if %s in %s", strs, fp)
         try:
@@ -142,30 +224,49 @@ class CheckYoo(object):
             # log.error(ret[1])
             return False
 
+    def _match_strs_in_output(self, cmd, ret, patterns):
+        if not ret[0]:
+            # log.error("run cmd %s failed", cmd)
+            return False
+
+        color = re.compile(r'\x1B\[([0-9]{1,2}((;[0-9]{1,2})*)?)?[m|K]')
+        newret = color.sub('', ret[1])
+        log.info("Got result %s", (ret[0], newret))
+
+        lines = newret.split('\r\n')
+        for p in patterns:
+            for line in lines:
+                if re.search(p, line.strip()):
+                    break
+            else:
+                log.error("can not match pattern %s in %s", p, cmd)
+                return False
+        return True
+
     def match_strs_in_cmd_output(self, cmd, patterns, timeout):
         log.info("start to match if %s in %s output", patterns, cmd)
         try:
             ret = self.run_cmd(cmd, timeout=timeout)
-            color = re.compile(r'\x1B\[([0-9]{1,2}((;[0-9]{1,2})*)?)?[m|K]')
-            newret = color.sub('', ret[1])
-            log.info("Got result %s", (ret[0], newret))
         except CommandTimeout as e:
             log.error(e)
             return False
 
-        if ret[0]:
-            lines = newret.split('\r\n')
-            for p in patterns:
-                for line in lines:
-                    if re.search(p, line.strip()):
-                        break
-                else:
-                    log.error("can not match pattern %s in %s", p, cmd)
-                    return False
-            return True
-        else:
-            # log.error("run cmd %s failed", cmd)
-            return False
+        return self._match_strs_in_output(cmd, ret, patterns)
+
+    def match_strs_in_cmds_output(self, probes, timeout):
+        """match_strs_in_cmd_output for a list of (cmd, patterns) probes
+
+        All commands are sent to the host in one batch, every probe is
+        evaluated even if a previous one failed.
+        """
+        log.info("start to match probes %s", probes)
+        rets = self.run_cmds([cmd for cmd, _ in probes], timeout=timeout)
+
+        results = [
+            self._match_strs_in_output(cmd, rets[cmd], patterns)
+            for cmd, patterns in probes
+        ]
+        return all(results)
 
     def call_func_by_name(self, name=''):
         func = getattr(self, name.lower(), None)
@@ -190,6 +291,29 @@ class CheckYoo(object):
         finally:
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
+    def _run_checkpoints_concurrently(self, checkpoints, cks):
+        if self.checkpoint_workers < 2 or len(checkpoints) < 2:
+            for checkpoint, cases in checkpoints:
+                self.run_checkpoint(checkpoint, cases, cks)
+            return
+
+        # workers have to log into the lane of the calling thread
+        lane = results_logs.lane
+
+        def worker(item):
+            results_logs.bind_lane(lane)
+            try:
+                self.run_checkpoint(item[0], item[1], cks)
+            finally:
+                results_logs.bind_lane(None)
+
+        pool = ThreadPool(min(self.checkpoint_workers, len(checkpoints)))
+        try:
+            pool.map(worker, checkpoints)
+        finally:
+            pool.close()
+            pool.join()
+
     def run_cases(self):
         cks = {}
         try:
@@ -200,14 +324,29 @@ class CheckYoo(object):
             # run check
             log.info("Start to run check points, please wait...")
 
-            roll_back_cases = None
+            ordered, final = [], []
             for checkpoint, cases in checkpoint_cases_map.items():
-                if checkpoint == "roll_back_check":
-                    roll_back_cases = cases
+                if checkpoint in self.final_checkpoints:
+                    final.append((checkpoint, cases))
+                else:
+                    ordered.append((checkpoint, cases))
+            final.sort(key=lambda item: self.final_checkpoints.index(item[0]))
+
+            # consecutive read-only checkpoints run concurrently, the others
+            # one by one at their place, so a checkpoint still runs before or
+            # after the state-mutating ones as it always did; the final ones
+            # at the very end
+            readonly = []
+            for checkpoint, cases in ordered:
+                if checkpoint in self.readonly_checkpoints:
+                    readonly.append((checkpoint, cases))
                     continue
+                self._run_checkpoints_concurrently(readonly, cks)
+                readonly = []
+                self.run_checkpoint(checkpoint, cases, cks)
+            self._run_checkpoints_concurrently(readonly, cks)
+            for checkpoint, cases in final:
                 self.run_checkpoint(checkpoint, cases, cks)
-            if roll_back_cases:
-                self.run_checkpoint("roll_back_check", roll_back_cases, cks)
         except Exception as e:
             log.error(e)
 
@@ -1,5 +1,4 @@
 import logging
-from fabric.network import disconnect_all
 import re
 import os
 import pickle
@@ -18,6 +17,15 @@ LOCAL_CHECKDATA_MAP_PKL = os.path.join(PROJECT_ROOT, 'logs', CHECKDATA_MAP_PKL)
 class CheckInstall(CheckYoo):
     """"""
 
+    readonly_checkpoints = (
+        "install_check", "partition_check", "static_network_check",
+        "bond_check", "vlan_check", "bond_vlan_check",
+        "nic_stat_dur_install_check", "dhcp_network_check", "hostname_check",
+        "lang_check", "ntp_check", "keyboard_check", "security_policy_check",
+        "kdump_check", "users_check", "firewall_check", "selinux_check",
+        "sshd_check", "grubby_check", "bootloader_check", "fips_check",
+        "iqn_check")
+
     def __init__(self):
         self._checkdata_map = None
 
@@ -26,7 +34,7 @@ class CheckInstall(CheckYoo):
 
         try:
             if os.path.exists(LOCAL_CHECKDATA_MAP_PKL):
-                os.system('rm -f {}'.format(LOCAL_CHECKDATA_MAP_PKL))
+                os.unlink(LOCAL_CHECKDATA_MAP_PKL)
 
             self.get_remote_file(REMOTE_CHECKDATA_MAP_PKL,
                                  LOCAL_CHECKDATA_MAP_PKL)
@@ -43,7 +51,7 @@ class CheckInstall(CheckYoo):
 
         return True
 
-    def _check_device_ifcfg_value(self, device_data_map):
+    def _device_ifcfg_value_probe(self, device_data_map):
         patterns = []
         for key, value in device_data_map.items():
             if key.isupper():
@@ -53,9 +61,9 @@ class CheckInstall(CheckYoo):
             device_data_map.get('DEVICE'))
         cmd = 'cat {}'.format(ifcfg_file)
 
-        return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
+        return cmd, patterns
 
-    def _check_device_connected(self, nics, expected_result='yes'):
+    def _device_connected_probe(self, nics, expected_result='yes'):
         patterns = []
         for nic in nics:
             if expected_result == 'yes':
@@ -66,21 +74,21 @@ class CheckInstall(CheckYoo):
 
         cmd = 'nmcli -t -f DEVICE,STATE dev'
 
-        return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
+        return cmd, patterns
 
-    def _check_device_ipv4_address(self, nic, ipv4):
+    def _device_ipv4_address_probe(self, nic, ipv4):
         patterns = [r'^inet\s+{}'.format(ipv4)]
         cmd = 'ip -f inet addr show {}'.format(nic)
 
-        return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
+        return cmd, patterns
 
-    def _check_device_ipv6_address(self, nic, ipv6):
+    def _device_ipv6_address_probe(self, nic, ipv6):
         patterns = [r'^inet6\s+{}'.format(ipv6)]
         cmd = 'ip -f inet6 addr show {}'.format(nic)
 
-        return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
+        return cmd, patterns
 
-    def _check_bond_has_slave(self, bond, slaves, expected_result='yes'):
+    def _bond_has_slave_probe(self, bond, slaves, expected_result='yes'):
         patterns = []
         for slave in slaves:
             if expected_result == 'yes':
@@ -91,20 +99,19 @@ class CheckInstall(CheckYoo):
 
         cmd = 'cat /proc/net/bonding/{}'.format(bond)
 
-        return self.match_strs_in_cmd_output(cmd, patterns, timeout=300)
+        return cmd, patterns
 
     def _check_recommended_swap_size(self):
-        cmd = "free -g | grep Mem | sed -r 's/\s*Mem:\s*([0-9]+)\s*.*/\\1/'"
-        ret = self.run_cmd(cmd, timeout=300)
-        if ret[0]:
-            memtotal = int(ret[1])
-        else:
-            return False
-
-        cmd = "free -g |grep Swap | sed -r 's/\s*Swap:\s*([0-9]+)\s*.*/\\1/'"
-        ret = self.run_cmd(cmd, timeout=300)
-        if ret[0]:
-            swap = int(ret[1])
+        cmds = {
+            "mem":
+            "free -g | grep Mem | sed -r 's/\s*Mem:\s*([0-9]+)\s*.*/\\1/'",
+            "swap":
+            "free -g |grep Swap | sed -r 's/\s*Swap:\s*([0-9]+)\s*.*/\\1/'"
+        }
+        rets = self.run_cmds(cmds, timeout=300)
+        if rets["mem"][0] and rets["swap"][0]:
+            memtotal = int(rets["mem"][1])
+            swap = int(rets["swap"][1])
         else:
             return False
 
@@ -259,44 +266,46 @@ class CheckInstall(CheckYoo):
         nic_ipv4 = device_data_map.get('IPADDR')
         nic_ipv6 = device_data_map.get('IPV6ADDR')
 
-        ck01 = self._check_device_ifcfg_value(device_data_map)
-
-        ck02 = True
+        probes = [self._device_ifcfg_value_probe(device_data_map)]
         if nic_ipv4:
-            ck02 = self._check_device_ipv4_address(nic_device, nic_ipv4)
-
-        ck03 = True
+            probes.append(self._device_ipv4_address_probe(nic_device, nic_ipv4))
         if nic_ipv6:
-            ck03 = self._check_device_ipv6_address(nic_device, nic_ipv6)
+            probes.append(self._device_ipv6_address_probe(nic_device, nic_ipv6))
+        probes.append(self._device_connected_probe([nic_device]))
 
-        ck04 = self._check_device_connected([nic_device])
+        return self.match_strs_in_cmds_output(probes, timeout=300)
 
-        return ck01 and ck02 and ck03 and ck04
-
-    def bond_check(self):
+    def _bond_probes(self):
         device_data_map = self._checkdata_map.get('network').get('bond')
         bond_device = device_data_map.get('DEVICE')
         bond_slaves = device_data_map.get('slaves')
 
-        ck01 = self._check_device_ifcfg_value(device_data_map)
-        ck02 = self._check_bond_has_slave(bond_device, bond_slaves)
-        ck03 = self._check_device_connected([bond_device] + bond_slaves)
+        return [
+            self._device_ifcfg_value_probe(device_data_map),
+            self._bond_has_slave_probe(bond_device, bond_slaves),
+            self._device_connected_probe([bond_device] + bond_slaves)
+        ]
 
-        return ck01 and ck02 and ck03
-
-    def vlan_check(self):
+    def _vlan_probes(self):
         device_data_map = self._checkdata_map.get('network').get('vlan')
         vlan_device = device_data_map.get('DEVICE')
 
-        ck01 = self._check_device_ifcfg_value(device_data_map)
-        ck02 = self._check_device_connected([vlan_device])
+        return [
+            self._device_ifcfg_value_probe(device_data_map),
+            self._device_connected_probe([vlan_device])
+        ]
 
-        return ck01 and ck02
+    def bond_check(self):
+        return self.match_strs_in_cmds_output(
+            self._bond_probes(), timeout=300)
+
+    def vlan_check(self):
+        return self.match_strs_in_cmds_output(
+            self._vlan_probes(), timeout=300)
 
     def bond_vlan_check(self):
-        ck01 = self.bond_check()
-        ck02 = self.vlan_check()
-        return ck01 and ck02
+        return self.match_strs_in_cmds_output(
+            self._bond_probes() + self._vlan_probes(), timeout=300)
 
     def nic_stat_dur_install_check(self):
         device_data_map = self._checkdata_map.get('network').get('nic')
@@ -304,20 +313,26 @@ class CheckInstall(CheckYoo):
         nic_status_dur_install = device_data_map.get('status')
 
         ck01 = not nic_status_dur_install
-        ck02 = self._check_device_ifcfg_value(device_data_map)
-        ck03 = self._check_device_connected(
-            [nic_device], expected_result='false')
+        ck02 = self.match_strs_in_cmds_output(
+            [
+                self._device_ifcfg_value_probe(device_data_map),
+                self._device_connected_probe(
+                    [nic_device], expected_result='false')
+            ],
+            timeout=300)
 
-        return ck01 and ck02 and ck03
+        return ck01 and ck02
 
     def dhcp_network_check(self):
         device_data_map = self._checkdata_map.get('network').get('dhcp')
         nic_device = device_data_map.get('DEVICE')
 
-        ck01 = self._check_device_ifcfg_value(device_data_map)
-        ck02 = self._check_device_connected([nic_device])
-
-        return ck01 and ck02
+        return self.match_strs_in_cmds_output(
+            [
+                self._device_ifcfg_value_probe(device_data_map),
+                self._device_connected_probe([nic_device])
+            ],
+            timeout=300)
 
     def hostname_check(self):
         hostname = self._checkdata_map.get('network').get('hostname')
@@ -407,7 +422,7 @@ class CheckInstall(CheckYoo):
         return False
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
         if self._set_checkdata_map():
             cks = self.run_cases()
         else:
@@ -3,7 +3,6 @@ import requests
 import os
 import time
 import re
-from fabric.network import disconnect_all
 from check_comm import CheckYoo
 from constants import KS_FILES_DIR, DELL_PET105_01, DELL_PER510_01
 from const_upgrade import CHECK_NEW_LVS, RHVM_DATA_MAP, \
@@ -21,6 +20,16 @@ log = logging.getLogger('bender')
 class CheckUpgrade(CheckYoo):
     """"""
 
+    # yum based checkpoints hold the yum lock, ntpd_status_check starts
+    # ntpd and update_again_unavailable_check runs an upgrade check on
+    # rhvm, so they are kept serial
+    readonly_checkpoints = (
+        "basic_upgrade_check", "packages_check", "settings_check",
+        "cmds_check", "signed_check", "knl_space_rpm_check",
+        "usr_space_rpm_check", "avc_denied_check", "iptables_status_check",
+        "sysstat_check", "ovirt_imageio_daemon_check", "boot_dmesg_log_check",
+        "separate_volumes_check", "etc_var_file_update_check")
+
     def __init__(self):
         self._source_build = None
         self._target_build = None
@@ -1240,14 +1249,12 @@ class CheckUpgrade(CheckYoo):
 
         log.info("Check host status on rhvm.")
 
-        count = 0
-        while (count < CHK_HOST_ON_RHVM_STAT_MAXCOUNT):
+        def host_up():
             host = self._rhvm.list_host(key="name", value=self._host_name)
-            if host and host.get('status') == 'up':
-                break
-            count = count + 1
-            time.sleep(CHK_HOST_ON_RHVM_STAT_INTERVAL)
-        else:
+            return host and host.get('status') == 'up'
+
+        timeout = CHK_HOST_ON_RHVM_STAT_MAXCOUNT * CHK_HOST_ON_RHVM_STAT_INTERVAL
+        if not self._rhvm.wait_for(host_up, timeout, self._host_name):
             log.error("Host is not up on rhvm.")
             return False
         log.info("Host is up on rhvm.")
@@ -1260,7 +1267,7 @@ class CheckUpgrade(CheckYoo):
             cmd = "systemctl reboot"
             self.run_cmd(cmd, timeout=10)
 
-        disconnect_all()
+        self.reset_connection()
         count = 0
         while (count < ENTER_SYSTEM_MAXCOUNT):
             time.sleep(ENTER_SYSTEM_INTERVAL)
@@ -1409,8 +1416,8 @@ class CheckUpgrade(CheckYoo):
             "findmnt": "findmnt -r -n"
         }
 
-        for k, v in cmdmap.items():
-            ret = self.run_cmd(v, timeout=FABRIC_TIMEOUT)
+        rets = self.run_cmds(cmdmap, timeout=FABRIC_TIMEOUT)
+        for k, ret in rets.items():
             if ret[0]:
                 check_infos[k] = ret[1]
                 log.info("***%s***:\n%s", k, ret[1])
@@ -1421,7 +1428,7 @@ class CheckUpgrade(CheckYoo):
         return True
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
         cks = {}
         try:
             if not self._collect_infos('old'):
@@ -2,9 +2,9 @@ import logging
 import re
 import time
 import functools
-from fabric.api import settings, run, local
-from fabric.network import disconnect_all
+from fabric.api import local
 from check_comm import CheckYoo
+from ssh_pool import ssh_pool
 from utils import get_checkpoint_cases_map
 from vdsmapi import RhevmAction
 from const_vdsm import RHVM_INFO, MACHINE_INFO, NFS_INFO, DELL_PER515_01
@@ -204,24 +204,19 @@ class CheckVdsm(CheckYoo):
 
     def _wait_host_status(self, host_name, expect_status):
         log.info("Waitting for the host %s" % expect_status)
-        i = 0
-        host_status = "unknown"
-        while True:
-            if i > 60:
-                raise RuntimeError("Timeout waitting for host %s as current host status is: %s" % (
-                    expect_status, host_status))
-            host_status = self._rhvm.list_host(host_name)['status']
-            log.info("HOST: %s" % host_status)
-            if host_status == expect_status:
-                break
-            elif host_status == 'install_failed':
-                raise RuntimeError("Host is not %s as current status is: %s" % (
-                    expect_status, host_status))
-            elif host_status == 'non_operational':
+        host_status = ["unknown"]
+
+        def reached():
+            host_status[0] = self._rhvm.list_host(host_name)['status']
+            log.info("HOST: %s" % host_status[0])
+            if host_status[0] in ('install_failed', 'non_operational'):
                 raise RuntimeError("Host is not %s as current status is: %s" % (
-                    expect_status, host_status))
-            time.sleep(10)
-            i += 1
+                    expect_status, host_status[0]))
+            return host_status[0] == expect_status
+
+        if not self._rhvm.wait_for(reached, 600, host_name):
+            raise RuntimeError("Timeout waitting for host %s as current host status is: %s" % (
+                expect_status, host_status[0]))
 
     def _update_network_vlan_tag(self):
         log.info("Updating network of datacenter with vlan tag")
@@ -402,11 +397,7 @@ class CheckVdsm(CheckYoo):
     def _clean_nfs_path(self, nfs_ip, nfs_pass, nfs_data_path):
         log.info("Cleaning the nfs path")
         cmd = "rm -rf %s/*" % nfs_data_path
-        with settings(
-            warn_only=True,
-            host_string='root@' + nfs_ip,
-            password=nfs_pass):
-            ret = run(cmd)
+        ret = ssh_pool.run(nfs_ip, 'root', nfs_pass, cmd)
         if ret.failed:
             raise RuntimeError("Failed to cleanup the nfs path %s" % nfs_data_path)
 
@@ -1018,18 +1009,17 @@ GATEWAY="{gateway}"\
 
     def _wait_vm_status(self, vm_name, expect_status):
         log.info("Waitting the vm to status %s" % expect_status)
-        i = 0
-        vm_status = "unknown"
-        while True:
-            if i > 30:
-                log.error("VM status is %s, not %s" % (vm_status, expect_status))
-                return False
-            vm_status = self._rhvm.list_vm(vm_name)['status']
-            log.info("VM: %s" % vm_status)
-            if vm_status == expect_status:
-                return True
-            time.sleep(10)
-            i += 1
+        vm_status = ["unknown"]
+
+        def reached():
+            vm_status[0] = self._rhvm.list_vm(vm_name)['status']
+            log.info("VM: %s" % vm_status[0])
+            return vm_status[0] == expect_status
+
+        if not self._rhvm.wait_for(reached, 300, vm_name):
+            log.error("VM status is %s, not %s" % (vm_status[0], expect_status))
+            return False
+        return True
 
     def _start_vm(self, vm_name):
         log.info("Start up the vm %s" % vm_name)
@@ -1229,7 +1219,7 @@ GATEWAY="{gateway}"\
             log.info("Run checkpoint:%s for cases:%s finished.", checkpoint, cases)
 
     def go_check(self):
-        disconnect_all()
+        self.reset_connection()
 
         is_setup_success = self._setup_before_check()
 
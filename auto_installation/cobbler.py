@@ -1,9 +1,33 @@
 import copy
+import time
+import threading
 import attr
 import xmlrpclib
 import logging
 
 from .constants import CB_API, CB_CREDENTIAL
+from .utils import ttl_cache
+
+# cobbler drops a token after 60 idle minutes, renew it well before
+TOKEN_TTL = 30 * 60
+PROFILES_TTL = 300
+
+# xmlrpclib keeps the http connection of a proxy alive between calls, but
+# a proxy can't be shared by threads, so there is one per thread and url
+_proxies = threading.local()
+
+
+def _get_proxy(cb_api):
+    proxies = _proxies.__dict__.setdefault('proxies', {})
+    if cb_api not in proxies:
+        proxies[cb_api] = xmlrpclib.ServerProxy(cb_api, allow_none=True)
+    return proxies[cb_api]
+
+
+@ttl_cache(PROFILES_TTL)
+def _get_profiles(cb_api):
+    ret = _get_proxy(cb_api).get_profiles()
+    return [pn['name'] for pn in ret if pn['name'].startswith('RHVH-4')]
 
 
 def _cb_cred_checker(instance, attribute, value):
@@ -26,6 +50,12 @@ class Cobbler(object):
         kernel_options="",
         kernel_options_post="")
 
+    # (cb_api, user) -> (token, expire time), shared by all the instances
+    _tokens = {}
+    _tokens_lock = threading.Lock()
+    # whether the server handles system.multicall, None until known
+    _multicall = None
+
     cb_api = attr.ib(default=CB_API)
     credential = attr.ib(default=CB_CREDENTIAL, validator=_cb_cred_checker)
     token = attr.ib(default=None)
@@ -36,21 +66,38 @@ class Cobbler(object):
         return self
 
     def __exit__(self, type, value, traceback):
-        self.log.warn("disconnected from {}".format(self.cb_api))
+        pass
 
     @property
     def proxy(self):
-        return xmlrpclib.Server(self.cb_api)
+        return _get_proxy(self.cb_api)
 
     @property
     def profiles(self):
-        ret = self.proxy.get_profiles()
-        return [pn['name'] for pn in ret if pn['name'].startswith('RHVH-4')]
-
-    def login(self):
-        self.token = self.proxy.login(*(self.credential))
-        self.log.info("logging into {}, get token is {}".format(self.cb_api,
-                                                                self.token))
+        return _get_profiles(self.cb_api)
+
+    def login(self, force=False):
+        key = (self.cb_api, self.credential[0])
+        with self._tokens_lock:
+            token, expire = self._tokens.get(key, (None, 0))
+            if force or not token or expire < time.time():
+                token = self.proxy.login(*(self.credential))
+                self.log.info("logging into {}, get token is {}".format(
+                    self.cb_api, token))
+                self._tokens[key] = (token, time.time() + TOKEN_TTL)
+        self.token = token
+
+    def _call(self, method, *args):
+        """Call a method taking the token as last arg, login again once if
+        the cached token has been dropped by cobbler
+        """
+        try:
+            return getattr(self.proxy, method)(*(args + (self.token, )))
+        except xmlrpclib.Fault as e:
+            if 'token' not in e.faultString:
+                raise
+            self.login(force=True)
+            return getattr(self.proxy, method)(*(args + (self.token, )))
 
     def find_system(self, name_pattern):
         self.log.info("start to querying system {}".format(name_pattern))
@@ -63,19 +110,38 @@ class Cobbler(object):
             self.log.warning("system not exists")
             return False
 
+    def _modify_and_save(self, system_id, params):
+        if Cobbler._multicall is not False:
+            multicall = xmlrpclib.MultiCall(self.proxy)
+            for k, v in params.items():
+                multicall.modify_system(system_id, k, v, self.token)
+            multicall.save_system(system_id, self.token)
+            try:
+                # iterating raises the fault of any failed call
+                list(multicall())
+                Cobbler._multicall = True
+                return
+            except xmlrpclib.Fault as e:
+                if Cobbler._multicall or 'multicall' not in e.faultString:
+                    raise
+                self.log.info("{} has no system.multicall".format(
+                    self.cb_api))
+                Cobbler._multicall = False
+
+        for k, v in params.items():
+            self._call('modify_system', system_id, k, v)
+        self._call('save_system', system_id)
+
     def add_new_system(self, **kwargs):
-        system_id = self.proxy.new_system(self.token)
+        system_id = self._call('new_system')
         params = copy.deepcopy(self.system_tpl)
         params.update(kwargs)
 
         self.log.info("add new host with {}".format(params))
-        for k, v in params.items():
-            self.proxy.modify_system(system_id, k, v, self.token)
-
-        self.proxy.save_system(system_id, self.token)
+        self._modify_and_save(system_id, params)
 
     def remove_system(self, system_name):
-        self.proxy.remove_system(system_name, self.token)
+        self._call('remove_system', system_name)
 
 
 if __name__ == '__main__':
@@ -17,7 +17,8 @@ BUILDS_SERVER_URL = "http://10.66.10.22:8090"
 
 CURRENT_IP_PORT = ('10.73.73.23', '5000')
 
-LOG_URL = "http://10.73.73.23:7788"
+# the /logs route of the server, it serves the compressed logs decompressed
+LOG_URL = "http://{0}:{1}/logs".format(CURRENT_IP_PORT[0], CURRENT_IP_PORT[1])
 
 STATIC_URL = ("http://{0}:{1}/"
               "static/ngn-auto-installation-kickstarts/%s").format(
@@ -128,12 +129,11 @@ else
 fi
 
 fetch /tmp/anamon http://{srv_ip}:{srv_port}/static/anamon.py
-python /tmp/anamon --server {srv_ip} --port {srv_port} --stage pre
-
-""".format(
+python /tmp/anamon --server {srv_ip} --port {srv_port} --stage pre --name """.format(
     srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1])
 
 PRE_SCRIPT_02 = """
+
 fetch /tmp/clean_disk http://{srv_ip}:{srv_port}/static/clean_disk.py
 python /tmp/clean_disk
 """.format(
@@ -2,7 +2,10 @@ import logging
 import os
 import time
 import commands
+import shutil
+import tarfile
 from constants import PROJECT_ROOT
+from utils import timed, clear_dir
 
 log = logging.getLogger('bender')
 
@@ -18,18 +21,22 @@ COV_HOST_RAW_RES_TAR_PATH = os.path.join(
     COV_HOST_DEAL_PATH, COV_RAW_RES_TAR_NAME)
 
 COV_LOCAL_DEAL_PATH = os.path.join(PROJECT_ROOT, 'logs', 'coverage', 'tmp')
-COV_LOCAL_RAW_RES_TAR_PATH = os.path.join(
-    COV_LOCAL_DEAL_PATH, COV_RAW_RES_TAR_NAME)
-COV_LOCAL_ALL_RAW_RES_TAR_PATH = os.path.join(
-    COV_LOCAL_DEAL_PATH, COV_ALL_RAW_RES_TAR_NAME)
 COV_LOCAL_FINAL_RES_PATH = os.path.join(
     PROJECT_ROOT, 'logs', 'coverage')
 
 
-def upload_coverage_raw_res_from_host(ck):
+def coverage_deal_path(job_key):
+    """Local dir collecting the raw results of a job, the jobs running at
+    the same time must not combine or remove the results of each other
+    """
+    return os.path.join(COV_LOCAL_DEAL_PATH, str(job_key))
+
+
+def upload_coverage_raw_res_from_host(ck, deal_path):
     # To makeup local deal path:
-    if not os.path.exists(COV_LOCAL_DEAL_PATH):
-        os.makedirs(COV_LOCAL_DEAL_PATH)
+    if not os.path.exists(deal_path):
+        os.makedirs(deal_path)
+    raw_res_tar_path = os.path.join(deal_path, COV_RAW_RES_TAR_NAME)
 
     # To compress .coverage* files under /boot/coverage on host
     cmd = "tar -zcf {} -C {} .".format(COV_HOST_RAW_RES_TAR_PATH,
@@ -41,32 +48,39 @@ def upload_coverage_raw_res_from_host(ck):
 
     # To upload coverage tar file to local server
     try:
-        ck.get_remote_file(COV_HOST_RAW_RES_TAR_PATH, COV_LOCAL_DEAL_PATH)
+        ck.get_remote_file(COV_HOST_RAW_RES_TAR_PATH, deal_path)
     except Exception as e:
         log.error(e)
         return False
 
     # To decompress coverage tar file on local server
-    cmd = "tar -zxf {} -C {}".format(COV_LOCAL_RAW_RES_TAR_PATH,
-                                     COV_LOCAL_DEAL_PATH)
-    os.system(cmd)
+    with timed("extracting {}".format(raw_res_tar_path)):
+        with tarfile.open(raw_res_tar_path) as tar:
+            tar.extractall(deal_path)
 
     # To delete the coverage tar file on local server
-    cmd = "rm -f {}".format(COV_LOCAL_RAW_RES_TAR_PATH)
-    os.system(cmd)
+    os.unlink(raw_res_tar_path)
 
     return True
 
 
-def download_all_coverage_raw_res_to_host(ck):
+def download_all_coverage_raw_res_to_host(ck, deal_path):
+    all_raw_res_tar_path = os.path.join(deal_path, COV_ALL_RAW_RES_TAR_NAME)
+
     # To compress all coverage file on local server
-    cmd = "tar -zcf {} -C {} .".format(
-        COV_LOCAL_ALL_RAW_RES_TAR_PATH, COV_LOCAL_DEAL_PATH)
-    os.system(cmd)
+    def skip_archive(tarinfo):
+        # the archive is created inside the dir being archived
+        if tarinfo.name == os.path.join('.', COV_ALL_RAW_RES_TAR_NAME):
+            return None
+        return tarinfo
+
+    with timed("creating {}".format(all_raw_res_tar_path)):
+        with tarfile.open(all_raw_res_tar_path, 'w:gz') as tar:
+            tar.add(deal_path, arcname='.', filter=skip_archive)
 
     # To download the coverage files to host
     try:
-        ck.put_remote_file(COV_LOCAL_ALL_RAW_RES_TAR_PATH, COV_HOST_DEAL_PATH)
+        ck.put_remote_file(all_raw_res_tar_path, COV_HOST_DEAL_PATH)
     except Exception as e:
         log.error(e)
         return False
@@ -112,13 +126,13 @@ def generate_coverage_html_res_on_host(ck):
     return True
 
 
-def upload_coverage_html_res_to_server(ck, src_build):
+def upload_coverage_html_res_to_server(ck, src_build, deal_path):
     final_result_path = os.path.join(
         COV_LOCAL_FINAL_RES_PATH, src_build)
     if not os.path.exists(final_result_path):
         os.mkdir(final_result_path)
     else:
-        os.system("rm -rf {}/*".format(final_result_path))
+        clear_dir(final_result_path)
 
     # To get html result from host
     remote_file = "{}/{}".format(COV_HOST_DEAL_PATH,
@@ -130,29 +144,26 @@ def upload_coverage_html_res_to_server(ck, src_build):
         return False
 
     # To decompress html result
-    cmd = "tar -zxf {}/{} -C {}".format(
-        final_result_path, COV_HTML_RES_TAR_NAME, final_result_path)
-    os.system(cmd)
-
-    cmd = "rm -f {}/{}".format(final_result_path, COV_HTML_RES_TAR_NAME)
-    os.system(cmd)
-
-    cmd = "mv {} {}".format(COV_LOCAL_ALL_RAW_RES_TAR_PATH, final_result_path)
-    os.system(cmd)
+    html_tar = os.path.join(final_result_path, COV_HTML_RES_TAR_NAME)
+    with timed("extracting {}".format(html_tar)):
+        with tarfile.open(html_tar) as tar:
+            tar.extractall(final_result_path)
+    os.unlink(html_tar)
 
-    cmd = "rm -rf {}".format(COV_LOCAL_DEAL_PATH)
-    os.system(cmd)
+    shutil.move(os.path.join(deal_path, COV_ALL_RAW_RES_TAR_NAME),
+                final_result_path)
+    shutil.rmtree(deal_path, ignore_errors=True)
 
     return True
 
 
-def generate_final_coverage_result(ck, src_build):
-    if not download_all_coverage_raw_res_to_host(ck):
+def generate_final_coverage_result(ck, src_build, deal_path):
+    if not download_all_coverage_raw_res_to_host(ck, deal_path):
         return False
     if not combine_all_coverage_raw_res_on_host(ck):
         return False
     if not generate_coverage_html_res_on_host(ck):
         return False
-    if not upload_coverage_html_res_to_server(ck, src_build):
+    if not upload_coverage_html_res_to_server(ck, src_build, deal_path):
         return False
     return True
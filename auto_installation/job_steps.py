@@ -0,0 +1,71 @@
+"""Progress of the kickstarts of a job, kept in redis
+
+Every (machine, kickstart) of a job goes through
+queued -> provisioning -> installing -> checking -> reported, or ends as
+failed. A job resumed after a restart picks up each kickstart from its
+last state instead of installing the hosts again.
+"""
+import json
+import time
+
+STEPS_KEY_TPL = 'jobs:{}:steps'
+# last install reported by a host on /done, read by resumed jobs as the
+# message may have been published while nobody was listening
+INSTALL_DONE_KEY_TPL = 'install:done:{}'
+STEPS_TTL = 7 * 24 * 3600
+INSTALL_DONE_TTL = 24 * 3600
+
+STEP_STATES = ('queued', 'provisioning', 'installing', 'checking',
+               'reported', 'failed')
+FINAL_STATES = ('reported', 'failed')
+
+
+def _field(machine, ks, index):
+    # a kickstart may run several times on a machine, e.g. the pressure
+    # ones, index is its position in the machine's kickstart list
+    return "{}:{}:{}".format(machine, ks, index)
+
+
+class JobSteps(object):
+    def __init__(self, rd_conn, job_id):
+        self.rd_conn = rd_conn
+        self.key = STEPS_KEY_TPL.format(job_id)
+
+    def get(self, machine, ks, index):
+        """The last step of ks on machine, with its state and time"""
+        step = self.rd_conn.hget(self.key, _field(machine, ks, index))
+        if not step:
+            return dict(state='queued', updated=None)
+        return json.loads(step)
+
+    def set(self, machine, ks, index, state, **extra):
+        if state not in STEP_STATES:
+            raise ValueError("Unknown step state {}".format(state))
+        step = dict(extra, state=state, updated=time.time())
+        pipe = self.rd_conn.pipeline()
+        pipe.hset(self.key, _field(machine, ks, index), json.dumps(step))
+        pipe.expire(self.key, STEPS_TTL)
+        pipe.execute()
+        return step
+
+    def all(self):
+        return dict((k, json.loads(v))
+                    for k, v in self.rd_conn.hgetall(self.key).items())
+
+
+def record_install_done(rd_conn, bkr_name, ip):
+    rd_conn.set(
+        INSTALL_DONE_KEY_TPL.format(bkr_name),
+        json.dumps(dict(ip=ip, time=time.time())),
+        ex=INSTALL_DONE_TTL)
+
+
+def install_done_since(rd_conn, bkr_name, since):
+    """ip of the install of bkr_name finished after `since`, if any"""
+    done = rd_conn.get(INSTALL_DONE_KEY_TPL.format(bkr_name))
+    if not done:
+        return None
+    done = json.loads(done)
+    if done['time'] < since:
+        return None
+    return done['ip']
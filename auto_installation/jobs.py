@@ -1,23 +1,39 @@
-import time
 import logging
 import attr
-from threading import Thread
+from threading import Thread, Lock
 import subprocess
 import os
+import time
+import uuid
 from .kickstarts import KickStartFiles
-from .beaker import Beaker, inst_watcher
+from .beaker import Beaker, inst_dispatcher, beaker_executor, \
+    INSTALL_TIMEOUT, BKR_TIMEOUT
 from .constants import CURRENT_IP_PORT, ARGS_TPL, HOSTS, CB_PROFILE, COVERAGE_TEST
 from .const_install import KS_KERPARAMS_MAP
 from .cobbler import Cobbler
 from .check_install import CheckInstall
 from .check_upgrade import CheckUpgrade
 from .check_vdsm import CheckVdsm
-from .util_result_index import cache_logs_summary
+from .util_result_index import upsert_log_summary
+from .job_steps import JobSteps, FINAL_STATES, install_done_since
+from .log_storage import compress_run, apply_retention
+from .ssh_pool import ssh_pool
 from reports import ResultsToPolarion
-from coverage_stat import upload_coverage_raw_res_from_host, generate_final_coverage_result
+from coverage_stat import upload_coverage_raw_res_from_host, generate_final_coverage_result, \
+    coverage_deal_path
 
 log = logging.getLogger("bender")
 
+# test flag of the kickstarts by name prefix
+KS_TEST_FLAGS = (("ati", "install"), ("atu", "upgrade"), ("atv", "vdsm"))
+
+
+def ks_test_flag(ks, default=None):
+    for prefix, flag in KS_TEST_FLAGS:
+        if ks.startswith(prefix):
+            return flag
+    return default
+
 
 @attr.s
 class JobRunner(object):
@@ -28,40 +44,75 @@ class JobRunner(object):
     # ks_filter = attr.ib(default='must')
     debug = attr.ib(default=False)
     test_flag = attr.ib(default='install')
+    # run every machine's kickstart list in its own thread
+    parallel = attr.ib(default=True)
+    # the machines leased to this job, all of them if None
+    machines = attr.ib(default=None)
+    # the leases.Lease of the machines, when run by the scheduler
+    lease = attr.ib(default=None)
+    # steps of the job are kept in redis to be resumed, if it has an id
+    job_id = attr.ib(default=None)
+    # report every kickstart as soon as its checks are done, instead of
+    # all of them once every host is done
+    pipelined = attr.ib(default=True)
+    to_polarion = attr.ib(default=False)
+    _steps = attr.ib(default=None, init=False)
+    _coverage_ck = attr.ib(default=None, init=False)
+    _coverage_lock = attr.ib(default=attr.Factory(Lock), init=False)
+    _coverage_path = attr.ib(default=None, init=False)
+    _reserved = attr.ib(default=attr.Factory(set), init=False)
 
-    def _wait_for_installation(self, p):
-        while True:
-            time.sleep(5)
-            log.info("waitting for install done")
-            msg = p.get_message(ignore_subscribe_messages=True)
-            if msg:
-                if 'done' in msg['data']:
-                    log.info('autoinstallation job is success')
-                    ip = msg['data'].split(',')[1]
-                    return ip
-                elif msg['data'] == 'fail':
-                    log.info('autoinstallation job is fail')
-                    return False
+    def __attrs_post_init__(self):
+        if self.job_id:
+            self._steps = JobSteps(self.rd_conn, self.job_id)
+        self._coverage_path = coverage_deal_path(self.job_id or
+                                                 uuid.uuid4().hex)
+
+    def _wait_for_installation(self, m, since):
+        log.info("waitting for install done on %s", m)
+        # a resumed job may have missed the /done of the host
+        ip = install_done_since(self.rd_conn, m, since)
+        if ip:
+            data = 'done,{}'.format(ip)
+        else:
+            timeout = since + INSTALL_TIMEOUT - time.time()
+            data = inst_dispatcher.wait(m, timeout=max(timeout, 1))
+        if not data:
+            log.error("provision job is time-out after %ss", INSTALL_TIMEOUT)
+            return False
+
+        with Cobbler() as cb:
+            log.info("remove system %s from cobbler", m)
+            cb.remove_system(m)
+
+        if 'done' in data:
+            log.info('autoinstallation job is success')
+            ip = data.split(',')[1]
+            return ip
+        else:
+            log.info('autoinstallation job is fail')
+            return False
 
     def _wait_for_cockpit(self, bkr_name):
-        pubsub_cockpit = self.rd_conn.pubsub()
-        pubsub_cockpit.subscribe("{0}-cockpit-result".format(bkr_name))
+        ch_name = "{0}-cockpit-result".format(bkr_name)
         while True:
-            time.sleep(5)
-            msg = pubsub_cockpit.get_message(ignore_subscribe_messages=True)
-            log.info(msg)
-            if msg:
-                if msg['data']:
-                    log.info("cockpit test is done")
-                    return msg['data']
+            data = inst_dispatcher.wait(ch_name)
+            log.info(data)
+            if data:
+                log.info("cockpit test is done")
+                return data
 
     def _provision(self, ks, m):
+        if self.lease and not self.lease.holds(m):
+            # another job owns the host now, don't wipe its install
+            log.error("%s isn't leased to this job anymore", m)
+            return -1
         bp = Beaker(
             srv_ip=CURRENT_IP_PORT[0], srv_port=CURRENT_IP_PORT[1], ks_file=ks)
-        bp.reserve(m)
-        ret = bp.reboot(m)
-
-        log.info("reboot {} with return code {}".format(m, ret))
+        if m not in self._reserved:
+            bp.reserve(m)
+        # the host takes minutes to reach pxe, set cobbler up meanwhile
+        reboot = beaker_executor.submit(bp.reboot, m)
 
         addition_kernel_params = ''
         if ks in KS_KERPARAMS_MAP:
@@ -78,8 +129,25 @@ class JobRunner(object):
                 profile=CB_PROFILE,
                 modify_interface=HOSTS.get(m)['nic'],
                 kernel_options=kargs)
+
+        # covers the retries of the reboot as well
+        ret = reboot.get(BKR_TIMEOUT * 4)
+        log.info("reboot {} with return code {}".format(m, ret))
         return ret
 
+    def _reserve_all(self, machines):
+        results = beaker_executor.run_all('reserve', machines)
+        for m, result in results.items():
+            try:
+                ret = result.get(BKR_TIMEOUT)
+            except Exception as e:
+                log.error("failed to reserve %s: %s", m, e)
+                continue
+            log.info("reserve %s with return code %s", m, ret)
+            if ret == 0:
+                # the others are reserved again by _provision
+                self._reserved.add(m)
+
     def _set_repos(self):
         if self.target_build:
             version = self.target_build.split("-host-")[-1]
@@ -89,7 +157,7 @@ class JobRunner(object):
 
     @property
     def ksins(self):
-        k = KickStartFiles()
+        k = KickStartFiles(self.machines)
         # k.ks_filter = self.ks_filter
         k.liveimg = self.build_url
         return k
@@ -98,105 +166,221 @@ class JobRunner(object):
     def job_queue(self):
         return self.ksins.get_job_queue()
 
+    def _get_step(self, m, ks, i):
+        if self._steps is None:
+            return dict(state='queued', updated=None)
+        return self._steps.get(m, ks, i)
+
+    def _set_step(self, m, ks, i, state, **extra):
+        if self._steps is None:
+            return dict(extra, state=state, updated=time.time())
+        return self._steps.set(m, ks, i, state, **extra)
+
+    def _install(self, m, ks, i):
+        """Provision m with ks, the ip of the host once it's installed"""
+        log.info("start provisioning on host %s with %s", m, ks)
+        # subscribe before rebooting so the /done callback can't be missed
+        inst_dispatcher.watch(m)
+        self._set_step(m, ks, i, 'provisioning')
+
+        if self.debug:
+            log.debug("now is debug mode, will not do provisioning")
+            ret = 0
+        else:
+            ret = self._provision(ks, m)
+
+        log.info(self.results_logs.current_log_path)
+
+        if ret != 0:
+            log.error("provisioning on host %s failed with return code %s",
+                      m, ret)
+            return None
+
+        log.info("provisioning on host %s finished " +
+                 "with kickstart file %s return code 0", m, ks)
+
+        step = self._set_step(m, ks, i, 'installing')
+        return self._wait_for_installation(m, step['updated'])
+
+    def _run_ks(self, m, ks, i=0):
+        self.results_logs.get_actual_logger(ks)
+
+        step = self._get_step(m, ks, i)
+        state = step['state']
+        if state in FINAL_STATES:
+            log.info("%s on host %s is %s already", ks, m, state)
+            return
+        if state == 'installing':
+            inst_dispatcher.watch(m)
+            if (not install_done_since(self.rd_conn, m, step['updated']) and
+                    step['updated'] + INSTALL_TIMEOUT < time.time()):
+                log.info("install of %s on host %s timed out meanwhile", ks,
+                         m)
+                state = 'queued'
+        if state != 'queued':
+            log.info("resume %s on host %s from %s", ks, m, state)
+
+        if state in ('queued', 'provisioning'):
+            ip = self._install(m, ks, i)
+        elif state == 'installing':
+            ip = self._wait_for_installation(m, step['updated'])
+        else:
+            ip = step['ip']
+
+        if not ip:
+            log.info("auto installation failed, contine to next job")
+            self._set_step(m, ks, i, 'failed')
+            return
+        if state != 'checking':
+            self._set_step(m, ks, i, 'checking', ip=ip)
+
+        log.info("auto installation finished, contine to chekcpoints")
+        try:
+            checked = self._check(m, ks, ip)
+        except Exception:
+            self._set_step(m, ks, i, 'failed')
+            raise
+        finally:
+            if self.pipelined:
+                self._report_ks(ks)
+        self._set_step(m, ks, i, 'reported' if checked else 'failed')
+
+    def _report_ks(self, ks):
+        final_path = self.results_logs.build_log_path
+        try:
+            report = ResultsToPolarion(final_path, '-l',
+                                       ks_test_flag(ks, self.test_flag),
+                                       self.target_build)
+            ret = report.update_ks_results(ks)
+            upsert_log_summary(final_path, self.rd_conn)
+            if self.to_polarion:
+                report.report_ks_to_polarion(ks, ret)
+        except Exception as e:
+            log.error(e)
+
+    def _check(self, m, ks, ip):
+        self.results_logs.logger_name = 'checkpoints'
+        self.results_logs.get_actual_logger(ks)
+
+        test_flag = ks_test_flag(ks)
+        if test_flag == "install":
+            ck = CheckInstall()
+        elif test_flag == "upgrade":
+            ck = CheckUpgrade()
+            ck.source_build = self.build_url.split('/')[-2]
+            ck.target_build = self.target_build
+        elif test_flag == "vdsm":
+            ck = CheckVdsm()
+            ck.build = self.build_url.split('/')[-2]
+        else:
+            log.error("ks file name %s isn't started with ati/atu/atv.", ks)
+            return False
+
+        log.info("ip is %s", ip)
+        ck.host_string, ck.host_user, ck.host_pass = (ip, 'root', 'redhat')
+        ck.beaker_name = m
+        ck.ksfile = ks
+
+        log.info(ck.go_check())
+        log.info("ssh pool stats: %s", ssh_pool.stats())
+
+        if test_flag == "install" and COVERAGE_TEST:
+            # the lanes of the job extract into the same local directory
+            with self._coverage_lock:
+                upload_coverage_raw_res_from_host(ck, self._coverage_path)
+                # the final results are generated on the host checked last
+                self._coverage_ck = ck
+
+            # TODO wati for cockpit new results format
+
+        return True
+
+    def _run_lane(self, m, ksl):
+        if self.parallel:
+            self.results_logs.start_lane(m)
+        try:
+            for i, ks in enumerate(ksl):
+                try:
+                    self._run_ks(m, ks, i)
+                except Exception as e:
+                    log.exception(e)
+        finally:
+            if self.parallel:
+                self.results_logs.stop_lane()
+
     def go(self):
         self._set_repos()
-        for m, ksl in self.job_queue.items():
-            for ks in ksl:
-                self.results_logs.get_actual_logger(ks)
-                log.info("start provisioning on host %s with %s", m, ks)
-
-                if self.debug:
-                    log.debug("now is debug mode, will not do provisioning")
-                    ret = 0
-                else:
-                    ret = self._provision(ks, m)
-
-                log.info(self.results_logs.current_log_path)
-
-                if ret == 0:
-                    log.info("provisioning on host %s finished " +
-                             "with kickstart file %s return code 0", m, ks)
-                    p = self.rd_conn.pubsub(ignore_subscribe_messages=True)
-                    log.info("subscribe channel %s", m)
-                    p.subscribe(m)
-                    log.info("start daemon thread to listen on channel %s", m)
-                    t = inst_watcher(m, p)
-                    t.setDaemon(True)
-                    t.start()
-                    t.join()
-
-                    ret = self._wait_for_installation(p)
-                    if not ret:
-                        log.info(
-                            "auto installation failed, contine to next job")
-                        continue
-                    else:
-                        log.info(
-                            "auto installation finished, contine to chekcpoints"
-                        )
-
-                        self.results_logs.logger_name = 'checkpoints'
-                        self.results_logs.get_actual_logger(ks)
-
-                        if ks.find("ati") == 0:
-                            self.test_flag = "install"
-                            ck = CheckInstall()
-                        elif ks.find("atu") == 0:
-                            self.test_flag = "upgrade"
-                            ck = CheckUpgrade()
-                            ck.source_build = self.build_url.split('/')[-2]
-                            ck.target_build = self.target_build
-                        elif ks.find("atv") == 0:
-                            self.test_flag = "vdsm"
-                            ck = CheckVdsm()
-                            ck.build = self.build_url.split('/')[-2]
-                        else:
-                            log.error(
-                                "ks file name %s isn't started with ati/atu/atv.",
-                                ks)
-                            continue
-
-                        log.info("ip is %s", ret)
-                        ck.host_string, ck.host_user, ck.host_pass = (ret,
-                                                                      'root',
-                                                                      'redhat')
-                        ck.beaker_name = m
-                        ck.ksfile = ks
-
-                        log.info(ck.go_check())
-
-                        if ks.find("ati") == 0 and COVERAGE_TEST:
-                            upload_coverage_raw_res_from_host(ck)
-
-                            # TODO wati for cockpit new results format
-                else:
-                    log.error(
-                        "provisioning on host %s failed with return code %s",
-                        m, ret)
-
-        self.generate_final_results()
-
-        if ks.find("ati") == 0 and COVERAGE_TEST:
-            generate_final_coverage_result(ck, self.build_url.split('/')[-2])
-
-        cache_logs_summary()
-        self.rd_conn.set("running", "0")
-
-    def generate_final_results(self):
+        job_queue = self.job_queue
+        if not self.debug:
+            self._reserve_all(job_queue.keys())
+
+        if self.parallel:
+            # one lane per beaker host, kickstarts of a host stay serial
+            lanes = []
+            for m, ksl in job_queue.items():
+                t = Thread(target=self._run_lane, name=m, args=(m, ksl))
+                t.setDaemon(True)
+                t.start()
+                lanes.append(t)
+            for t in lanes:
+                t.join()
+        else:
+            for m, ksl in job_queue.items():
+                self._run_lane(m, ksl)
+
+        self.generate_final_results(self._queue_test_flag(job_queue))
+
+        if self._coverage_ck:
+            generate_final_coverage_result(self._coverage_ck,
+                                           self.build_url.split('/')[-2],
+                                           self._coverage_path)
+
+        self.store_logs()
+
+    def store_logs(self):
+        try:
+            # the job log is still written to, leave it plain
+            compress_run(self.results_logs.build_log_path,
+                         skip=(self.results_logs.current_log_file, ))
+            apply_retention()
+        except Exception as e:
+            log.error(e)
+
+    def _queue_test_flag(self, job_queue):
+        """test flag of the whole job, the one of its kickstarts"""
+        flags = set(
+            ks_test_flag(ks) for ksl in job_queue.values() for ks in ksl)
+        flags.discard(None)
+        if len(flags) == 1:
+            return flags.pop()
+        if flags:
+            log.warning("kickstarts of several test flags %s, report as %s",
+                        sorted(flags), self.test_flag)
+        return self.test_flag
+
+    def generate_final_results(self, test_flag=None):
         try:
-            log_path = self.results_logs.current_log_path
-            build_name = self.results_logs.parse_img_url()
-            if build_name not in log_path:
+            final_path = self.results_logs.build_log_path
+            if not os.path.exists(final_path):
                 return
-            final_path = os.path.join(
-                log_path.split(build_name)[0], build_name)
-            report = ResultsToPolarion(final_path, '-l', self.test_flag,
+            # with pipelined, the kickstarts are in polarion already
+            action = '-b' if self.to_polarion and not self.pipelined else '-l'
+            report = ResultsToPolarion(final_path, action,
+                                       test_flag or self.test_flag,
                                        self.target_build)
             report.run()
+            upsert_log_summary(final_path, self.rd_conn)
+            if self.to_polarion and self.pipelined:
+                report.finish_testrun()
         except Exception as e:
             log.error(e)
 
 
-def job_runner(img_url, rd_conn, results_logs, target_build=None):
-    ins = JobRunner(img_url, rd_conn, results_logs, target_build)
+def job_runner(img_url,
+               rd_conn,
+               results_logs,
+               target_build=None,
+               machines=None):
+    ins = JobRunner(
+        img_url, rd_conn, results_logs, target_build, machines=machines)
     return Thread(target=ins.go)
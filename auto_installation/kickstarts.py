@@ -4,30 +4,54 @@
 
 import os
 import logging
+from threading import Lock
 
 from pykickstart.parser import Script
 from pykickstart.constants import KS_SCRIPT_PRE, KS_SCRIPT_POST
 
 from constants import KS_FILES_DIR, KS_FILES_AUTO_DIR, \
     HOSTS, POST_SCRIPT_01, POST_SCRIPT_02, PRE_SCRIPT_01, PRE_SCRIPT_02, TEST_LEVEL
-from utils import get_machine_ksl_map, get_ks_machine_map
+from utils import get_machine_ksl_map, get_ks_machine_map, timed, makedirs
 
 loger = logging.getLogger('bender')
 
 
-class KickStartFiles(object):
-    """"""
-
-    def __init__(self):
-        self._liveimg = None
-
-    @property
-    def liveimg(self):
-        return self._liveimg
-
-    @liveimg.setter
-    def liveimg(self, val):
-        self._liveimg = val
+class KickStartRenderer(object):
+    """Renders the kickstarts under KS_FILES_DIR for a build and a host
+
+    Templates are read once and reread only when their mtime changes,
+    rendered files are kept in memory and served from there, and only
+    the ones whose content changed are written to KS_FILES_AUTO_DIR.
+    """
+
+    def __init__(self, src_dir=KS_FILES_DIR, out_dir=KS_FILES_AUTO_DIR):
+        self.src_dir = src_dir
+        self.out_dir = out_dir
+        # ks -> (mtime, text before the liveimg line, text after it)
+        self._templates = {}
+        # (ks, mtime, liveimg, nic_name, bkr_name) -> content
+        self._rendered = {}
+        # ks -> content of the last render
+        self._current = {}
+        self._lock = Lock()
+
+    def _template(self, ks):
+        path = os.path.join(self.src_dir, ks)
+        mtime = os.path.getmtime(path)
+        cached = self._templates.get(ks)
+        if cached and cached[0] == mtime:
+            return cached
+
+        with open(path) as fp:
+            lines = fp.readlines()
+        for i, line in enumerate(lines):
+            if "liveimg --url=" in line:
+                cached = (mtime, ''.join(lines[:i]), ''.join(lines[i + 1:]))
+                break
+        else:
+            cached = (mtime, ''.join(lines), None)
+        self._templates[ks] = cached
+        return cached
 
     def _generate_ks_script(self,
                             content,
@@ -54,48 +78,123 @@ class KickStartFiles(object):
             sp.lineno = lineno
         return sp
 
-    def _convert_to_auto_ks(self):
-        loger.info("remove all old files under {}".format(KS_FILES_AUTO_DIR))
-        os.system("rm -f {}/*".format(KS_FILES_AUTO_DIR))
-
-        ks_machine_map = get_ks_machine_map()
-
-        for ks in ks_machine_map:
+    def _scripts(self, ks, nic_name, bkr_name):
+        if 'atv_bonda' not in ks:
+            post_script = self._generate_ks_script(
+                POST_SCRIPT_01.format(nic_name) + bkr_name,
+                error_on_fail=False)
+        else:
+            post_script = self._generate_ks_script(
+                POST_SCRIPT_02 + bkr_name, error_on_fail=False)
+
+        pre_script = self._generate_ks_script(
+            PRE_SCRIPT_01 + bkr_name + PRE_SCRIPT_02,
+            script_type=KS_SCRIPT_PRE,
+            error_on_fail=False)
+        return pre_script.__str__() + post_script.__str__()
+
+    def render(self, ks, liveimg, nic_name, bkr_name):
+        with self._lock:
+            mtime, head, tail = self._template(ks)
+            key = (ks, mtime, liveimg, nic_name, bkr_name)
+            content = self._rendered.get(key)
+            if content is None:
+                if tail is None:
+                    content = head
+                else:
+                    content = head + "liveimg --url=" + liveimg + "\n" + tail
+                content += self._scripts(ks, nic_name, bkr_name)
+                # only the latest render of a ks is worth keeping
+                for k in [k for k in self._rendered if k[0] == ks]:
+                    del self._rendered[k]
+                self._rendered[key] = content
+            self._current[ks] = content
+            return content
+
+    def get(self, ks):
+        """The last rendered content of ks, None if not rendered yet"""
+        return self._current.get(ks)
+
+    def save(self, ks, content):
+        """Write content to the auto dir unless it's there already"""
+        path = os.path.join(self.out_dir, ks)
+        try:
+            with open(path) as fp:
+                if fp.read() == content:
+                    return False
+        except IOError:
+            pass
+        makedirs(self.out_dir)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w') as fp:
+            fp.write(content)
+        os.rename(tmp_path, path)
+        return True
+
+    def remove_stale(self, kss):
+        """Remove the files of the auto dir which aren't in kss"""
+        removed = 0
+        kss = set(kss)
+        makedirs(self.out_dir)
+        for name in os.listdir(self.out_dir):
+            if name not in kss:
+                os.unlink(os.path.join(self.out_dir, name))
+                removed += 1
+        with self._lock:
+            for ks in self._current.keys():
+                if ks not in kss:
+                    del self._current[ks]
+        return removed
+
+
+ks_renderer = KickStartRenderer()
 
-            bkr_name = ks_machine_map.get(ks)
 
-            nic_name = HOSTS.get(bkr_name).get("nic").keys()[0].split('-')[-1]
+class KickStartFiles(object):
+    """"""
 
-            ks_ = os.path.join(KS_FILES_DIR, ks)
-            ks_out = os.path.join(KS_FILES_AUTO_DIR, ks)
+    def __init__(self, machines=None):
+        self._liveimg = None
+        # only the kickstarts of these machines, all of them if None
+        self.machines = machines
 
-            new_live_img = "liveimg --url=" + self._liveimg
+    @property
+    def liveimg(self):
+        return self._liveimg
 
-            os.system("sed '/liveimg --url=/ c\{}' {} > {}".format(
-                new_live_img, ks_, ks_out))
+    @liveimg.setter
+    def liveimg(self, val):
+        self._liveimg = val
 
-            if 'atv_bonda' not in ks:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_01.format(nic_name) + bkr_name,
-                    error_on_fail=False)
-            else:
-                post_script = self._generate_ks_script(
-                    POST_SCRIPT_02 + bkr_name, error_on_fail=False)
+    def _convert_to_auto_ks(self):
+        ks_machine_map = get_ks_machine_map()
 
-            pre_script = self._generate_ks_script(
-                PRE_SCRIPT_01 + PRE_SCRIPT_02,
-                script_type=KS_SCRIPT_PRE,
-                error_on_fail=False)
+        written = 0
+        for ks in ks_machine_map:
+            bkr_name = ks_machine_map.get(ks)
+            if self.machines is not None and bkr_name not in self.machines:
+                # may be in use by another job
+                continue
+            nic_name = HOSTS.get(bkr_name).get("nic").keys()[0].split('-')[-1]
+            content = ks_renderer.render(ks, self._liveimg, nic_name,
+                                         bkr_name)
+            written += ks_renderer.save(ks, content)
 
-            with open(ks_out, "a") as fp:
-                fp.write(pre_script.__str__())
-                fp.write(post_script.__str__())
+        removed = ks_renderer.remove_stale(ks_machine_map.keys())
+        loger.info("%s kickstart files rewritten, %s stale ones removed",
+                   written, removed)
 
     def get_job_queue(self):
         print "current test level is %x" % TEST_LEVEL
-        self._convert_to_auto_ks()
-
-        return get_machine_ksl_map()
+        with timed("generating kickstart files"):
+            self._convert_to_auto_ks()
+
+        machine_ksl_map = get_machine_ksl_map()
+        if self.machines is not None:
+            machine_ksl_map = dict((m, ksl)
+                                   for m, ksl in machine_ksl_map.items()
+                                   if m in self.machines)
+        return machine_ksl_map
 
 
 if __name__ == '__main__':
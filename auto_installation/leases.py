@@ -0,0 +1,171 @@
+"""Exclusive leases of the beaker hosts, kept in redis
+
+A lease is a `lease:machine:<host>` key holding its owner, with a ttl.
+Acquiring, renewing and releasing are lua scripts comparing the owner
+before touching a key, so a runner can never take or drop the host of
+another one. The holder renews its leases from a heartbeat thread; the
+leases of a crashed runner just expire and the hosts can be taken again.
+"""
+import time
+import logging
+from threading import Thread, Lock
+
+import attr
+
+from .constants import HOSTS
+from .utils import init_redis
+
+log = logging.getLogger('bender')
+
+LEASE_KEY_TPL = 'lease:machine:{}'
+LEASE_TTL = 120
+
+# KEYS: the lease keys, ARGV: owner, ttl in ms
+# all or nothing, the owner can acquire its own leases again
+ACQUIRE_LUA = """
+for _, key in ipairs(KEYS) do
+    local holder = redis.call('GET', key)
+    if holder and holder ~= ARGV[1] then
+        return 0
+    end
+end
+for _, key in ipairs(KEYS) do
+    redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+end
+return 1
+"""
+
+# returns the indexes (1-based) of the keys held by someone else now,
+# an expired lease nobody took meanwhile is taken back
+RENEW_LUA = """
+local lost = {}
+for i, key in ipairs(KEYS) do
+    local holder = redis.call('GET', key)
+    if holder == ARGV[1] then
+        redis.call('PEXPIRE', key, ARGV[2])
+    elseif not holder then
+        redis.call('SET', key, ARGV[1], 'PX', ARGV[2])
+    else
+        table.insert(lost, i)
+    end
+end
+return lost
+"""
+
+RELEASE_LUA = """
+local released = 0
+for _, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+        released = released + 1
+    end
+end
+return released
+"""
+
+
+def _lease_key(machine):
+    return LEASE_KEY_TPL.format(machine)
+
+
+@attr.s
+class Lease(object):
+    """The hosts held by one owner, returned by `LeaseManager.acquire`"""
+    manager = attr.ib()
+    owner = attr.ib()
+    machines = attr.ib()
+    # hosts taken by another owner after our lease expired
+    lost = attr.ib(default=attr.Factory(set), init=False)
+
+    def holds(self, machine):
+        return machine in self.machines and machine not in self.lost
+
+    def release(self):
+        self.manager.release(self)
+
+
+@attr.s
+class LeaseManager(object):
+    rd_conn = attr.ib(default=attr.Factory(init_redis))
+    ttl = attr.ib(default=LEASE_TTL)
+    _leases = attr.ib(default=attr.Factory(dict), init=False)
+    _lock = attr.ib(default=attr.Factory(Lock), init=False)
+    _thread = attr.ib(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        self._acquire = self.rd_conn.register_script(ACQUIRE_LUA)
+        self._renew = self.rd_conn.register_script(RENEW_LUA)
+        self._release = self.rd_conn.register_script(RELEASE_LUA)
+
+    def acquire(self, owner, machines):
+        """Lease all the machines to owner, None if any is held already"""
+        machines = sorted(machines)
+        keys = [_lease_key(m) for m in machines]
+        if not self._acquire(keys=keys, args=[owner, self.ttl * 1000]):
+            return None
+        lease = Lease(self, owner, machines)
+        with self._lock:
+            self._leases[owner] = lease
+            self._start_heartbeat()
+        log.info("%s leased %s", owner, machines)
+        return lease
+
+    def renew(self, lease):
+        keys = [_lease_key(m) for m in lease.machines]
+        lost = self._renew(keys=keys, args=[lease.owner, self.ttl * 1000])
+        for i in lost:
+            m = lease.machines[int(i) - 1]
+            if m not in lease.lost:
+                log.error("%s lost the lease of %s", lease.owner, m)
+                lease.lost.add(m)
+
+    def release(self, lease):
+        with self._lock:
+            self._leases.pop(lease.owner, None)
+        self.force_release(lease.owner, lease.machines)
+        log.info("%s released %s", lease.owner, lease.machines)
+
+    def force_release(self, owner, machines):
+        """Drop the leases of an owner known to be gone, e.g. a job
+        interrupted by a restart, instead of waiting for them to expire
+        """
+        keys = [_lease_key(m) for m in machines]
+        if not keys:
+            return 0
+        return self._release(keys=keys, args=[owner])
+
+    def occupancy(self, machines=None):
+        """host -> {owner, ttl}, owner is None for a free host"""
+        machines = sorted(machines or HOSTS.keys())
+        pipe = self.rd_conn.pipeline()
+        for m in machines:
+            pipe.get(_lease_key(m))
+            pipe.ttl(_lease_key(m))
+        ret = pipe.execute()
+        occupancy = {}
+        for i, m in enumerate(machines):
+            owner, ttl = ret[2 * i], ret[2 * i + 1]
+            occupancy[m] = dict(
+                owner=owner, ttl=ttl if owner and ttl >= 0 else None)
+        return occupancy
+
+    def _heartbeat(self):
+        while True:
+            # a lease survives two missed heartbeats
+            time.sleep(self.ttl / 3.0)
+            with self._lock:
+                leases = self._leases.values()
+            for lease in leases:
+                try:
+                    self.renew(lease)
+                except Exception as e:
+                    # retried on next beat, the ttl leaves room for it
+                    log.error("renewing leases of %s failed: %s",
+                              lease.owner, e)
+
+    def _start_heartbeat(self):
+        if self._thread:
+            return
+        self._thread = Thread(target=self._heartbeat, name="leases")
+        self._thread.setDaemon(True)
+        self._thread.start()
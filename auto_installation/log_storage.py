@@ -0,0 +1,154 @@
+"""Storage of the finished runs under logs/
+
+Once a run is finished its files are gzipped and identical files are
+hardlinked to a single object under logs/.objects, keyed by sha1 of the
+compressed content. Reading goes through `open_log`, which finds the .gz
+of a file transparently.
+"""
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import logging
+import time
+
+from constants import PROJECT_ROOT
+
+log = logging.getLogger('bender')
+
+LOGS_DIR = os.path.join(PROJECT_ROOT, 'logs')
+OBJECTS_DIR = os.path.join(LOGS_DIR, '.objects')
+GZ_SUFFIX = '.gz'
+# kept plain, they are read by the results index and polarion reports
+KEEP_PLAIN = ('final_results.json', )
+# runs older than this are deleted by `apply_retention`
+RETENTION_DAYS = 90
+DATE_DIR_RE = re.compile(r'^\d{4}-\d{2}-\d{2}$')
+
+
+def _gzip_file(path):
+    gz_path = path + GZ_SUFFIX
+    tmp_path = gz_path + '.tmp'
+    with open(path, 'rb') as src:
+        # mtime=0 and no file name, so the same content gives the same bytes
+        with open(tmp_path, 'wb') as raw:
+            with gzip.GzipFile('', 'wb', 6, raw, mtime=0) as dst:
+                shutil.copyfileobj(src, dst)
+    st = os.stat(path)
+    os.utime(tmp_path, (st.st_atime, st.st_mtime))
+    os.rename(tmp_path, gz_path)
+    os.unlink(path)
+    return gz_path
+
+
+def _sha1_of(path):
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for chunk in iter(lambda: fp.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+def _dedupe(path):
+    """Replace path by a hardlink of the object having the same content"""
+    digest = _sha1_of(path)
+    obj_dir = os.path.join(OBJECTS_DIR, digest[:2])
+    obj = os.path.join(obj_dir, digest)
+    if not os.path.exists(obj_dir):
+        os.makedirs(obj_dir)
+    if not os.path.exists(obj):
+        os.link(path, obj)
+        return False
+    if os.path.samefile(path, obj):
+        return False
+    tmp_path = path + '.tmp'
+    os.link(obj, tmp_path)
+    os.rename(tmp_path, path)
+    return True
+
+
+def compress_run(run_dir, skip=()):
+    """gzip and dedupe every file of a finished run
+
+    Files in `skip`, e.g. the log still being written, are left as is.
+    """
+    compressed = deduped = 0
+    start = time.time()
+    for dpath, _, files in os.walk(run_dir):
+        for fname in files:
+            path = os.path.join(dpath, fname)
+            if fname in KEEP_PLAIN or path in skip or os.path.islink(path):
+                continue
+            try:
+                if not fname.endswith(GZ_SUFFIX):
+                    path = _gzip_file(path)
+                    compressed += 1
+                deduped += _dedupe(path)
+            except (IOError, OSError) as e:
+                log.error("failed to store %s: %s", path, e)
+    log.info("compressed %s files, deduped %s files of %s in %.1fs",
+             compressed, deduped, run_dir, time.time() - start)
+
+
+def apply_retention(days=RETENTION_DAYS):
+    """Delete the date dirs older than `days` and the unused objects"""
+    oldest = time.strftime("%Y-%m-%d",
+                           time.localtime(time.time() - days * 86400))
+    for date in os.listdir(LOGS_DIR):
+        if DATE_DIR_RE.match(date) and date < oldest:
+            log.info("removing logs of %s", date)
+            shutil.rmtree(os.path.join(LOGS_DIR, date), ignore_errors=True)
+
+    if not os.path.isdir(OBJECTS_DIR):
+        return
+    for dpath, _, files in os.walk(OBJECTS_DIR):
+        for fname in files:
+            path = os.path.join(dpath, fname)
+            # only the object itself links to the content anymore
+            if os.stat(path).st_nlink == 1:
+                os.unlink(path)
+
+
+def resolve_log(relpath):
+    """Path of the stored file for relpath under logs/, maybe its .gz
+
+    Returns (path, compressed), path is None if there is nothing there.
+    """
+    root = os.path.realpath(LOGS_DIR)
+    path = os.path.realpath(os.path.join(LOGS_DIR, relpath))
+    if path != root and not path.startswith(root + os.sep):
+        return None, False
+    if os.path.exists(path):
+        return path, False
+    if os.path.isfile(path + GZ_SUFFIX):
+        return path + GZ_SUFFIX, True
+    return None, False
+
+
+def open_log(relpath):
+    """Open a file under logs/ whether it's been compressed or not"""
+    path, compressed = resolve_log(relpath)
+    if path is None or os.path.isdir(path):
+        raise IOError("No such log: {}".format(relpath))
+    if compressed:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def list_logs(relpath):
+    """Entries of a dir under logs/, with the .gz suffixes hidden"""
+    path, _ = resolve_log(relpath)
+    if path is None or not os.path.isdir(path):
+        raise IOError("No such log dir: {}".format(relpath))
+    ret = []
+    for fname in sorted(os.listdir(path)):
+        if fname.startswith('.'):
+            continue
+        if os.path.isdir(os.path.join(path, fname)):
+            ret.append(fname + '/')
+        elif fname.endswith(GZ_SUFFIX):
+            ret.append(fname[:-len(GZ_SUFFIX)])
+        else:
+            ret.append(fname)
+    return ret
@@ -1,7 +1,20 @@
+import re
 import attr
+from threading import Lock
 from pymongo import MongoClient
 from urllib import quote_plus
 
+# MongoClient is a thread safe connection pool, one per uri is enough
+_clients = {}
+_clients_lock = Lock()
+
+
+def get_client(uri):
+    with _clients_lock:
+        if uri not in _clients:
+            _clients[uri] = MongoClient(uri)
+        return _clients[uri]
+
 
 @attr.s
 class MongoQuery(object):
@@ -17,7 +30,7 @@ class MongoQuery(object):
 
     @property
     def db(self):
-        return MongoClient(self.uri)[self.db_name]
+        return get_client(self.uri)[self.db_name]
 
     def collection(self, name):
         return self.db[name]
@@ -25,26 +38,27 @@ class MongoQuery(object):
     def rhvh_build_names(self, q='4.1'):
         c = self.collection('resources.rhevh36ngn')
         query = 'redhat-virtualization-host-{}'.format(q)
+        # an anchored prefix regex can be served by an index on build_name
         return [
-            i['build_name'] for i in c.find()
-            if i['build_name'].startswith(query)
+            i['build_name']
+            for i in c.find({'build_name': {'$regex': '^' + re.escape(query)}},
+                            projection={'build_name': True, '_id': False})
         ]
 
     def machines(self, q=''):
         c = self.collection('machines')
-        # for i in c.find(projection=['basic.ids.hostname', 'comments']):
-        #     print i.get('comments', [''])
-        auto = [
-            i['basic']['ids']['hostname']
-            for i in c.find(projection=['basic.ids.hostname', 'comments'])
-            if i['basic']['ids'] and i.get('comments', [''])[0] == 'zoidberg'
-        ]
-        manual = [
-            i['basic']['ids']['hostname']
-            for i in c.find(projection=['basic.ids.hostname', 'comments'])
-            if i['basic']['ids'] and i.get('comments', [''])[0] != 'zoidberg'
+        # machines whose first comment is zoidberg are managed by us
+        pipeline = [
+            {'$match': {'basic.ids.hostname': {'$exists': True}}},
+            {'$project': {
+                'hostname': '$basic.ids.hostname',
+                'auto': {'$eq': [{'$arrayElemAt': ['$comments', 0]},
+                                 'zoidberg']},
+            }},
+            {'$group': {'_id': '$auto', 'hostnames': {'$push': '$hostname'}}},
         ]
-        return [auto, manual]
+        groups = dict((i['_id'], i['hostnames']) for i in c.aggregate(pipeline))
+        return [groups.get(True, []), groups.get(False, [])]
 
 
 if __name__ == '__main__':
@@ -0,0 +1,213 @@
+"""Export of test records to polarion
+
+Records are added one by one with `add_test_record_by_fields`, paced by
+a token bucket instead of fixed sleeps: its rate goes up while the
+server keeps up and is halved on every transient failure, and the failed
+call is retried. `PolarionExporter.submit` runs the export on the
+exporter thread so jobs don't wait for polarion.
+"""
+import time
+import socket
+import logging
+import datetime
+from threading import Lock
+from multiprocessing.pool import ThreadPool
+
+log = logging.getLogger('bender')
+
+RATE = 1.0
+MAX_RATE = 10.0
+MIN_RATE = 0.1
+BURST = 3
+RETRIES = 3
+# how long a job waits for its exports before finishing the test run
+EXPORT_TIMEOUT = 600
+
+
+class TransientError(Exception):
+    """A failure worth retrying later, e.g. a time-out or throttling"""
+    pass
+
+
+class TokenBucket(object):
+    """Allows `rate` calls per second on average, `burst` at once
+
+    The rate grows by `rate_step` on every success, up to max_rate, and
+    is halved on every failure.
+    """
+
+    def __init__(self,
+                 rate=RATE,
+                 burst=BURST,
+                 max_rate=MAX_RATE,
+                 min_rate=MIN_RATE,
+                 rate_step=0.5):
+        self.rate = rate
+        self.burst = burst
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate_step = rate_step
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._lock = Lock()
+
+    def _refill(self):
+        now = time.time()
+        self._tokens = min(self.burst,
+                           self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+    def speed_up(self):
+        with self._lock:
+            self._refill()
+            self.rate = min(self.max_rate, self.rate + self.rate_step)
+
+    def slow_down(self):
+        with self._lock:
+            self._refill()
+            self.rate = max(self.min_rate, self.rate / 2.0)
+            self._tokens = min(self._tokens, 0)
+
+
+def make_records(results, executed_by='yaniwang', duration=66.6):
+    """add_test_record_by_fields arguments of {test case id: result},
+    the results other than passed/failed (e.g. blocked) are skipped
+    """
+    executed = datetime.datetime.now()
+    records = []
+    for test_case_id, result in sorted(results.items()):
+        if result not in ('passed', 'failed'):
+            continue
+        records.append(
+            dict(
+                test_case_id=test_case_id,
+                test_result=result,
+                test_comment=("pass without error" if result == 'passed' else
+                              "failed, detail in attatched log"),
+                executed_by=executed_by,
+                executed=executed,
+                duration=duration))
+    return records
+
+
+class PylarionBackend(object):
+    def __init__(self, project_id):
+        self.project_id = project_id
+
+    def _transient(self, e):
+        if isinstance(e, (IOError, socket.error)):
+            return True
+        # suds faults of an overloaded or restarting server
+        return type(e).__name__ == 'WebFault' and any(
+            w in str(e) for w in ('timeout', 'Timeout', 'unavailable'))
+
+    def _call(self, func, *args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if self._transient(e):
+                raise TransientError(str(e))
+            raise
+
+    def open_run(self, test_run_id):
+        from pylarion.test_run import TestRun
+        return self._call(
+            TestRun, project_id=self.project_id, test_run_id=test_run_id)
+
+    def add_record(self, run, record):
+        self._call(run.add_test_record_by_fields, **record)
+
+
+class PolarionExporter(object):
+    def __init__(self, backend, retries=RETRIES, bucket=None):
+        self.backend = backend
+        self.retries = retries
+        self.bucket = bucket or TokenBucket()
+        self._pool = None
+        # test run id -> AsyncResults not known to be successful
+        self._pending = {}
+        self._lock = Lock()
+
+    def _call(self, func, *args):
+        for attempt in range(self.retries + 1):
+            self.bucket.acquire()
+            try:
+                ret = func(*args)
+            except TransientError as e:
+                self.bucket.slow_down()
+                if attempt == self.retries:
+                    raise
+                log.info("polarion call failed (%s), retry at %.1f/s", e,
+                         self.bucket.rate)
+                continue
+            self.bucket.speed_up()
+            return ret
+
+    def export(self, test_run_id, records):
+        """Add records to the test run, returns how many were added"""
+        start = time.time()
+        run = self._call(self.backend.open_run, test_run_id)
+        for record in records:
+            self._call(self.backend.add_record, run, record)
+        log.info("exported %s records to %s in %.1fs",
+                 len(records), test_run_id, time.time() - start)
+        return len(records)
+
+    def submit(self, test_run_id, records):
+        """export on the exporter thread, returns an AsyncResult"""
+        with self._lock:
+            if self._pool is None:
+                # a single thread, the exports share the server rate
+                self._pool = ThreadPool(1)
+            result = self._pool.apply_async(self.export,
+                                            (test_run_id, records))
+            pending = self._pending.setdefault(test_run_id, [])
+            pending[:] = [
+                r for r in pending if not (r.ready() and r.successful())
+            ]
+            pending.append(result)
+        return result
+
+    def wait(self, test_run_id, timeout=None):
+        """Wait for the exports submitted to a test run, False if some are
+        still going or failed
+        """
+        with self._lock:
+            pending = list(self._pending.get(test_run_id, []))
+        deadline = time.time() + timeout if timeout is not None else None
+        ok = True
+        for result in pending:
+            remaining = None
+            if deadline is not None:
+                remaining = max(deadline - time.time(), 0)
+            result.wait(remaining)
+            if not result.ready():
+                return False
+            if not result.successful():
+                try:
+                    result.get()
+                except Exception as e:
+                    log.error("export to %s failed: %s", test_run_id, e)
+                ok = False
+        if ok:
+            with self._lock:
+                # keep what was submitted meanwhile
+                left = [
+                    r for r in self._pending.get(test_run_id, [])
+                    if r not in pending
+                ]
+                if left:
+                    self._pending[test_run_id] = left
+                else:
+                    self._pending.pop(test_run_id, None)
+        return ok
@@ -1,7 +1,6 @@
 import os
 import time
 import argparse
-import datetime
 try:
     from pylarion.test_run import TestRun
 except ImportError:
@@ -10,12 +9,31 @@ from constants import TR_ID, TR_PROJECT_ID, TR_TPL, LOG_URL
 from const_install import KS_PRESSURE_MAP
 import re
 import json
-from utils import get_testcase_map
+import threading
+from utils import get_testcase_map, get_testcase_index
+from polarion_export import PolarionExporter, PylarionBackend, make_records, \
+    EXPORT_TIMEOUT
 from collections import OrderedDict
 
 import ssl
 ssl._create_default_https_context = ssl._create_unverified_context
 
+# lanes of a job update the same final results file
+_jfile_lock = threading.Lock()
+_exporter = None
+_exporter_lock = threading.Lock()
+# test run id -> Event set once the test run exists in polarion
+_testruns_created = {}
+
+
+def polarion_exporter():
+    """The exporter shared by every report, created on first use"""
+    global _exporter
+    with _exporter_lock:
+        if _exporter is None:
+            _exporter = PolarionExporter(PylarionBackend(TR_PROJECT_ID))
+        return _exporter
+
 
 def make_test_run():
     return TestRun(
@@ -40,44 +58,15 @@ class ResultsToPolarion(object):
     def get_current_date():
         return time.strftime("%m%d%H%M", time.localtime())
 
-    def create_testrun(self, title, level='Must'):
+    def _testrun_id(self, title):
+        return TR_ID.format(title.replace(".", "_"), self.get_current_date())
+
+    def create_testrun(self, title, level='Must', testrun_id=None):
         ret = TestRun.create(TR_PROJECT_ID,
-                             TR_ID.format(
-                                 title.replace(".", "_"),
-                                 self.get_current_date()),
+                             testrun_id or self._testrun_id(title),
                              TR_TPL.format(level))
         return ret
 
-    def export_to_polarion(
-            self,
-            tr,
-            test_case_id,
-            test_result,  # passed or failed
-            test_comment="pass without error",
-            executed_by='yaniwang',  # krb_id
-            executed=datetime.datetime.now(),
-            duration=66.6):
-
-        if test_result == 'passed':
-            tr.add_test_record_by_fields(
-                test_case_id=test_case_id,
-                test_result=test_result,
-                test_comment=test_comment,
-                executed_by=executed_by,
-                executed=executed,
-                duration=duration)
-        elif test_result == 'failed':
-            tr.add_test_record_by_fields(
-                test_case_id=test_case_id,
-                test_result=test_result,
-                test_comment="failed, detail in attatched log",
-                executed_by=executed_by,
-                executed=executed,
-                duration=duration)
-        else:
-            # TODO deal with blocked
-            pass
-
     def _parse_checkpoints(self, res):
         ks = res.split('/')[-2]
         if ks in KS_PRESSURE_MAP:
@@ -107,9 +96,9 @@ class ResultsToPolarion(object):
                         newret[k] = newret[k] and ret[k]
 
                 if len(iqns) == num and len(set(iqns)) != num:
-                    testcase_map = get_testcase_map()
-                    for k, v in testcase_map.items():
-                        if 'iqn_check' in v and k in newret:
+                    index = get_testcase_index()
+                    for k in index.cases_of_checkpoint('iqn_check'):
+                        if k in newret:
                             newret[k] = False
                             break
         return newret
@@ -137,49 +126,158 @@ class ResultsToPolarion(object):
         log_url = LOG_URL + self.path.split('logs')[-1]
         return log_url
 
+    def _gen_sum(self, results, old_sum=None):
+        actual_run_cases = []
+        pass_num = 0
+        failed_num = 0
+        for ret in results.values():
+            actual_run_cases.extend(list(ret.keys()))
+            values = list(ret.values())
+            pass_num = pass_num + values.count('passed')
+            failed_num = failed_num + values.count('failed')
+
+        need_run_cases = list(get_testcase_map().keys())
+        final_sum = OrderedDict()
+        final_sum['title'] = self._gen_title()
+        final_sum['log_url'] = self._gen_log_url()
+        final_sum['total'] = len(need_run_cases)
+        final_sum['passed'] = pass_num
+        final_sum['failed'] = failed_num
+        final_sum['error'] = len(need_run_cases) - len(actual_run_cases)
+        final_sum['errorlist'] = list(
+            set(need_run_cases) - set(actual_run_cases))
+        if old_sum and old_sum.get('testrun_id'):
+            # test run of the results already sent to polarion
+            final_sum['testrun_id'] = old_sum['testrun_id']
+        return final_sum
+
+    def _load_jfile(self):
+        try:
+            with open(os.path.join(self.path, self.jfilename)) as fp:
+                return json.load(fp, object_pairs_hook=OrderedDict)
+        except (IOError, ValueError):
+            return None
+
+    def _write_jfile(self, final_results):
+        final_results_jfile = os.path.join(self.path, self.jfilename)
+        tmp_path = final_results_jfile + '.tmp'
+        # readers of the file never see it half written
+        with open(tmp_path, 'w') as json_file:
+            json_file.write(json.dumps(final_results, indent=4))
+        os.rename(tmp_path, final_results_jfile)
+        return final_results_jfile
+
     def _gen_results_jfile(self):
         root_path = self.path
 
         final_results = OrderedDict()
         final_results[self.source_build] = OrderedDict()
-        actual_run_cases = []
-        pass_num = 0
-        failed_num = 0
         for a, b, c in os.walk(root_path):
             for ks in sorted(b):
                 ret = self._parse_checkpoints(os.path.join(a, ks, 'checkpoints'))
                 final_results[self.source_build][ks] = ret
-                actual_run_cases.extend(list(ret.keys()))
-                values = list(ret.values())
-                pass_num = pass_num + values.count('passed')
-                failed_num = failed_num + values.count('failed')
             break
 
-        need_run_cases = list(get_testcase_map().keys())
-        final_results['sum'] = OrderedDict()
-        final_results['sum']['title'] = self._gen_title()
-        final_results['sum']['log_url'] = self._gen_log_url()
-        final_results['sum']['total'] = len(need_run_cases)
-        final_results['sum']['passed'] = pass_num
-        final_results['sum']['failed'] = failed_num
-        final_results['sum']['error'] = len(need_run_cases) - len(
-            actual_run_cases)
-        final_results['sum']['errorlist'] = list(
-            set(need_run_cases) - set(actual_run_cases))
-
-        final_results_jfile = os.path.join(root_path,
-                                           self.jfilename)
         try:
-            with open(final_results_jfile, 'w') as json_file:
-                json_file.write(
-                    json.dumps(
-                        final_results, indent=4))
-
-            return final_results_jfile
+            with _jfile_lock:
+                old_results = self._load_jfile() or {}
+                final_results['sum'] = self._gen_sum(
+                    final_results[self.source_build], old_results.get('sum'))
+                return self._write_jfile(final_results)
         except Exception as e:
             print e
             return None
 
+    def update_ks_results(self, ks):
+        """Merge the results of a single finished kickstart into the final
+        results file, returns them
+        """
+        ret = self._parse_checkpoints(
+            os.path.join(self.path, ks, 'checkpoints'))
+        with _jfile_lock:
+            final_results = self._load_jfile() or OrderedDict()
+            results = final_results.get(self.source_build, {})
+            results[ks] = ret
+            final_results[self.source_build] = OrderedDict(
+                sorted(results.items()))
+            final_results['sum'] = self._gen_sum(
+                final_results[self.source_build], final_results.get('sum'))
+            self._write_jfile(final_results)
+        return ret
+
+    def _get_testrun(self):
+        """Test run of the results file, created on first use
+
+        The id is reserved in the results file under the lock, polarion is
+        only called once it's released, so lanes can go on writing their
+        results meanwhile.
+        """
+        while True:
+            with _jfile_lock:
+                final_results = self._load_jfile()
+                title = final_results['sum']['title']
+                tr_id = final_results['sum'].get('testrun_id')
+                create = not tr_id
+                if create:
+                    tr_id = self._testrun_id(title)
+                    final_results['sum']['testrun_id'] = tr_id
+                    self._write_jfile(final_results)
+                    _testruns_created[tr_id] = threading.Event()
+                created = _testruns_created.get(tr_id)
+
+            if create:
+                break
+            if created is None:
+                return TestRun(project_id=TR_PROJECT_ID, test_run_id=tr_id)
+            # another lane is creating it, the id is gone from the results
+            # file if it failed, then try again
+            created.wait()
+
+        try:
+            tr = self.create_testrun(title, testrun_id=tr_id)
+            tr.group_id = self.source_build
+            tr.description = title
+            tr.status = 'inprogress'
+            tr.update()
+            print tr.uri
+            return tr
+        except Exception:
+            # let the next kickstart try again
+            with _jfile_lock:
+                final_results = self._load_jfile()
+                final_results['sum'].pop('testrun_id', None)
+                self._write_jfile(final_results)
+            raise
+        finally:
+            created.set()
+            with _jfile_lock:
+                _testruns_created.pop(tr_id, None)
+
+    def report_ks_to_polarion(self, ks, ret):
+        """Export the results of one kickstart as soon as it's finished,
+        returns the AsyncResult of the export
+        """
+        tr = self._get_testrun()
+        print "Transport results of {} to {}".format(ks, tr.test_run_id)
+        return polarion_exporter().submit(tr.test_run_id, make_records(ret))
+
+    def finish_testrun(self, timeout=EXPORT_TIMEOUT):
+        final_results = self._load_jfile()
+        tr_id = final_results and final_results['sum'].get('testrun_id')
+        if not tr_id:
+            return
+        if not polarion_exporter().wait(tr_id, timeout):
+            print "Exports to {} unfinished or failed, " \
+                "leave it in progress".format(tr_id)
+            return
+        ks_list = sorted(
+            ks.encode() for ks in final_results.get(self.source_build, {}))
+        tr = TestRun(project_id=TR_PROJECT_ID, test_run_id=tr_id)
+        tr.description = '{} with {}'.format(final_results['sum']['title'],
+                                             ks_list)
+        tr.status = 'finished'
+        tr.update()
+
     def _report_to_polarion_by_jfile(self, jfile):
         if jfile.split('/')[-1] != self.jfilename:
             print "Input wrong results json file."
@@ -204,12 +302,10 @@ class ResultsToPolarion(object):
         print tr.uri
         print tr.test_run_id
 
-        rets = final_results.get(self.source_build).values()
-        for ret in rets:
-            for k, v in ret.items():
-                self.export_to_polarion(tr, k, v)
-                print "be nice with server, sleep 1 sec"
-                time.sleep(1)
+        records = []
+        for ret in final_results.get(self.source_build).values():
+            records.extend(make_records(ret))
+        polarion_exporter().export(tr.test_run_id, records)
 
         print "Transport results to polarion finished."
 
@@ -0,0 +1,127 @@
+"""One REST client per RHVM engine, shared by every checker
+
+The engine CA cert is downloaded once per fqdn and kept on disk, the
+requests session keeps its connections (and the persistent-auth cookie)
+alive across checkers and lanes.
+"""
+import os
+import base64
+import logging
+import shutil
+from threading import Lock
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from rhvm_events import EventWaiter
+
+log = logging.getLogger('bender')
+
+CERT_URL = ("https://{rhevm_fqdn}/ovirt-engine/services"
+            "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
+CERT_PATH = "/tmp/rhevm-{rhevm_fqdn}.cert"
+PEM_MARKER = "-----BEGIN CERTIFICATE-----"
+POOL_MAXSIZE = 16
+
+_clients = {}
+_clients_lock = Lock()
+
+
+class RhvmClient(object):
+    """requests.Session-like client of one engine
+
+    get/post/put/delete take the same arguments as requests; a request
+    failing ssl verification fetches the cert again and is retried once,
+    the engine may have been reinstalled with a new CA.
+    """
+    auth_format = "{user}@{domain}:{password}"
+
+    def __init__(self, rhevm_fqdn, user, password, domain):
+        self.rhevm_fqdn = rhevm_fqdn
+        token = base64.b64encode(
+            self.auth_format.format(
+                user=user, domain=domain, password=password))
+        self.headers = {
+            "Prefer": "persistent-auth",
+            "Accept": "application/json",
+            "Content-type": "application/xml",
+            "Authorization": "Basic {token}".format(token=token)
+        }
+        self.cert = CERT_PATH.format(rhevm_fqdn=rhevm_fqdn)
+        self._cert_lock = Lock()
+        self._events = None
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_MAXSIZE)
+        self.session.mount("https://", adapter)
+
+        if not self._cert_is_valid():
+            self.fetch_cert()
+
+    @property
+    def events(self):
+        """The EventWaiter of the engine"""
+        with self._cert_lock:
+            if self._events is None:
+                self._events = EventWaiter(self)
+            return self._events
+
+    def _cert_is_valid(self):
+        try:
+            with open(self.cert) as fp:
+                return PEM_MARKER in fp.read()
+        except IOError:
+            return False
+
+    def fetch_cert(self):
+        with self._cert_lock:
+            r = requests.get(
+                CERT_URL.format(rhevm_fqdn=self.rhevm_fqdn),
+                stream=True,
+                verify=False)
+
+            if r.status_code != 200:
+                raise RuntimeError("Can not get the cert file from %s" %
+                                   self.rhevm_fqdn)
+
+            tmp_path = self.cert + ".tmp"
+            with open(tmp_path, 'wb') as f:
+                r.raw.decode_content = True
+                shutil.copyfileobj(r.raw, f)
+            # lanes reading the old cert meanwhile see a complete file
+            os.rename(tmp_path, self.cert)
+        if not self._cert_is_valid():
+            raise RuntimeError("Invalid cert file got from %s" %
+                               self.rhevm_fqdn)
+
+    def request(self, method, url, **kwargs):
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.SSLError as e:
+            log.info("ssl error with %s (%s), fetch its cert again",
+                     self.rhevm_fqdn, e)
+            self.fetch_cert()
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request("PUT", url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request("DELETE", url, **kwargs)
+
+
+def get_rhvm_client(rhevm_fqdn,
+                    user="admin",
+                    password="password",
+                    domain="internal"):
+    key = (rhevm_fqdn, user, password, domain)
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = RhvmClient(rhevm_fqdn, user, password, domain)
+        return _clients[key]
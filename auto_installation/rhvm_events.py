@@ -0,0 +1,140 @@
+"""Wait on RHVM host/vm states by following the engine events
+
+One poller per engine reads the new events with `/events?from=<id>`,
+backing off while nothing happens, and wakes up the waiters an event is
+about, which then check their state again. Waiters still check every
+`recheck` seconds, in case the engine logged nothing for a change.
+"""
+import time
+import logging
+from threading import Thread, Lock, Event
+
+log = logging.getLogger('bender')
+
+MIN_POLL_INTERVAL = 2
+MAX_POLL_INTERVAL = 30
+RECHECK_INTERVAL = 60
+
+
+def mentions(*names):
+    """Event matcher for the events whose description has one of names"""
+
+    def match(event):
+        desc = event.get('description', '')
+        return any(name in desc for name in names if name)
+
+    return match
+
+
+class _Waiter(object):
+    def __init__(self, match):
+        self.match = match
+        self.event = Event()
+
+
+class EventWaiter(object):
+    def __init__(self, client):
+        self.client = client
+        self.api_url = "https://{}/ovirt-engine/api/events".format(
+            client.rhevm_fqdn)
+        self._waiters = []
+        self._lock = Lock()
+        self._thread = None
+        self._last_id = None
+        self._interval = MIN_POLL_INTERVAL
+
+    def _get_events(self, params):
+        r = self.client.get(
+            self.api_url,
+            headers=self.client.headers,
+            verify=self.client.cert,
+            params=params)
+        if r.status_code != 200:
+            raise RuntimeError("Can not list events of %s" %
+                               self.client.rhevm_fqdn)
+        return r.json().get('event', [])
+
+    def _init_last_id(self):
+        try:
+            events = self._get_events({'max': 1})
+        except Exception as e:
+            # waiters fall back to rechecking until the next try
+            log.info("getting last event of %s failed: %s",
+                     self.client.rhevm_fqdn, e)
+            return
+        last_id = max([int(ev['id']) for ev in events] or [0])
+        with self._lock:
+            if self._last_id is None:
+                self._last_id = last_id
+
+    def _poll(self):
+        while True:
+            with self._lock:
+                if not self._waiters:
+                    self._thread = None
+                    return
+                interval = self._interval
+            time.sleep(interval)
+
+            if self._last_id is None:
+                self._init_last_id()
+                continue
+            try:
+                events = self._get_events({'from': self._last_id})
+            except Exception as e:
+                log.info("polling events of %s failed: %s",
+                         self.client.rhevm_fqdn, e)
+                events = []
+            events = [ev for ev in events if int(ev['id']) > self._last_id]
+
+            with self._lock:
+                if events:
+                    self._last_id = max(int(ev['id']) for ev in events)
+                    self._interval = MIN_POLL_INTERVAL
+                else:
+                    self._interval = min(self._interval * 2,
+                                         MAX_POLL_INTERVAL)
+                for waiter in self._waiters:
+                    if any(waiter.match(ev) for ev in events):
+                        waiter.event.set()
+
+    def _register(self, waiter):
+        with self._lock:
+            init = self._last_id is None
+        if init:
+            # an http request, don't hold up the poller and other waiters
+            self._init_last_id()
+        with self._lock:
+            self._waiters.append(waiter)
+            # a new wait is likely to be about something about to happen
+            self._interval = MIN_POLL_INTERVAL
+            if not self._thread:
+                self._thread = Thread(target=self._poll)
+                self._thread.setDaemon(True)
+                self._thread.start()
+
+    def _unregister(self, waiter):
+        with self._lock:
+            self._waiters.remove(waiter)
+
+    def wait(self, check, timeout, match=None, recheck=RECHECK_INTERVAL):
+        """Wait until check() returns true, at most timeout seconds
+
+        check runs again whenever an event matched by `match` comes, and
+        every `recheck` seconds. Exceptions of check are propagated.
+        Returns whether check passed in time.
+        """
+        waiter = _Waiter(match or (lambda event: True))
+        self._register(waiter)
+        try:
+            deadline = time.time() + timeout
+            while True:
+                waiter.event.clear()
+                if check():
+                    return True
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                waiter.event.wait(min(recheck, remaining))
+        finally:
+            self._unregister(waiter)
@@ -1,7 +1,6 @@
 import logging
-import base64
-import requests
-import shutil
+from rhvm_client import get_rhvm_client
+from rhvm_events import mentions
 from time import sleep
 
 log = logging.getLogger('bender')
@@ -14,20 +13,8 @@ class RhevmAction:
    RhevmAction("rhevm-40-1.englab.nay.redhat.com").add_new_host("10.66.8.217", "autotest01", "redhat")
    """
 
-    auth_format = "{user}@{domain}:{password}"
     api_url = "https://{rhevm_fqdn}/ovirt-engine/api/{item}"
 
-    headers = {
-        "Prefer": "persistent-auth",
-        "Accept": "application/json",
-        "Content-type": "application/xml"
-    }
-
-    cert_url = ("https://{rhevm_fqdn}/ovirt-engine/services"
-                "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
-
-    rhevm_cert = "/tmp/rhevm.cert"
-
     def __init__(self,
                  rhevm_fqdn,
                  user="admin",
@@ -38,29 +25,17 @@ class RhevmAction:
         self.user = user
         self.password = password
         self.domain = domain
-        self.token = base64.b64encode(
-            self.auth_format.format(
-                user=self.user, domain=self.domain, password=self.password))
-        self.headers.update({
-            "Authorization":
-            "Basic {token}".format(token=self.token)
-        })
-        self._get_rhevm_cert_file()
-        self.req = requests.Session()
-
-    def _get_rhevm_cert_file(self):
-        r = requests.get(
-            self.cert_url.format(rhevm_fqdn=self.rhevm_fqdn),
-            stream=True,
-            verify=False)
-
-        if r.status_code == 200:
-            with open(self.rhevm_cert, 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-        else:
-            raise RuntimeError("Can not get the cert file from %s" %
-                               self.rhevm_fqdn)
+        # shared by every RhevmAction of the engine
+        self.req = get_rhvm_client(rhevm_fqdn, user, password, domain)
+        self.headers = self.req.headers
+        self.rhevm_cert = self.req.cert
+
+    def wait_for(self, check, timeout, *names):
+        """Wait until check() passes, checking again as soon as an event
+        mentioning one of names comes
+        """
+        match = mentions(*names) if names else None
+        return self.req.events.wait(check, timeout, match=match)
 
     ###################################
     # Datacenter related functions
@@ -314,21 +289,17 @@ class RhevmAction:
                 log.info("r.status_code is %d", r.status_code)
                 raise RuntimeError("Failed to execute upgradecheck.")
 
-        count_max = 13
-        sleep_time = 300
+        timeout = 13 * 300
         if rhvm_version == "rhvm41":
-            count_max = 10
-            sleep_time = 30
-
-        count = 0
-        while (count < count_max):
-            sleep(sleep_time)
-            update_available = self.list_host(
-                key="id", value=host_id)['update_available']
-            if update_available == 'true':
-                break
-            count = count + 1
-        else:
+            timeout = 10 * 30
+
+        host_name = self.list_host(key="id", value=host_id)['name']
+
+        def update_available():
+            host = self.list_host(key="id", value=host_id)
+            return host['update_available'] == 'true'
+
+        if not self.wait_for(update_available, timeout, host_name):
             log.error("update is not available.")
             return False
 
@@ -412,15 +383,11 @@ class RhevmAction:
             # check upgrade status
             description = 'Host {} upgrade was completed successfully'.format(
                 host_name)
-            count = 0
-            while (count < 4):
-                sleep(300)
-                if self._get_host_event_by_des(host_name, description):
-                    log.info(description)
-                    break
-                count = count + 1
-            else:
+            if not self.wait_for(
+                    lambda: self._get_host_event_by_des(host_name, description),
+                    4 * 300, host_name):
                 raise RuntimeError("Upgrade host %s failed." % host_name)
+            log.info(description)
         else:
             raise RuntimeError("Can't find host with name %s" % host_name)
 
@@ -0,0 +1,225 @@
+"""Queue of the builds to test
+
+Jobs wait in a redis sorted set, by priority then age, and are started
+as soon as every machine they need could be leased (see leases.py), so
+jobs needing different machines run side by side.
+"""
+import time
+import uuid
+import json
+import logging
+from threading import Thread, Event
+
+import attr
+
+from .utils import init_redis, get_machine_ksl_map, ResultsAndLogs
+from .jobs import JobRunner
+from .leases import LeaseManager
+from .job_steps import JobSteps
+
+log = logging.getLogger('bender')
+
+QUEUE_KEY = 'jobs:queue'
+JOB_KEY_TPL = 'jobs:{}'
+RUNNING_KEY = 'jobs:running'
+SCHEDULE_INTERVAL = 10
+
+
+def _score(priority, created):
+    # higher priority first, then first come first served
+    return -int(priority) * 1e10 + created
+
+
+@attr.s
+class JobScheduler(object):
+    rd_conn = attr.ib(default=attr.Factory(init_redis))
+    leases = attr.ib(default=None)
+    _wakeup = attr.ib(default=attr.Factory(Event), init=False)
+    _thread = attr.ib(default=None, init=False)
+
+    def __attrs_post_init__(self):
+        if self.leases is None:
+            self.leases = LeaseManager(self.rd_conn)
+
+    def enqueue(self, img_url, target_build=None, priority=0, machines=None):
+        job_id = uuid.uuid4().hex
+        created = time.time()
+        pipe = self.rd_conn.pipeline()
+        pipe.hmset(
+            JOB_KEY_TPL.format(job_id),
+            dict(
+                id=job_id,
+                img_url=img_url,
+                target_build=target_build or '',
+                priority=priority,
+                machines=json.dumps(machines),
+                state='queued',
+                created=created))
+        pipe.zadd(QUEUE_KEY, _score(priority, created), job_id)
+        pipe.execute()
+        log.info("job %s of %s queued", job_id, img_url)
+        self._wakeup.set()
+        return job_id
+
+    def cancel(self, job_id):
+        """Remove a job from the queue, running jobs can't be cancelled"""
+        if not self.rd_conn.zrem(QUEUE_KEY, job_id):
+            return False
+        self.rd_conn.hset(JOB_KEY_TPL.format(job_id), 'state', 'cancelled')
+        return True
+
+    def job(self, job_id):
+        job = self.rd_conn.hgetall(JOB_KEY_TPL.format(job_id))
+        if not job:
+            return None
+        job['machines'] = json.loads(job['machines'])
+        job['steps'] = JobSteps(self.rd_conn, job_id).all()
+        position = self.rd_conn.zrank(QUEUE_KEY, job_id)
+        job['position'] = position + 1 if position is not None else None
+        return job
+
+    def status(self):
+        queued = self.rd_conn.zrange(QUEUE_KEY, 0, -1)
+        return dict(
+            depth=len(queued),
+            queued=[self.job(job_id) for job_id in queued],
+            running=[
+                self.job(job_id)
+                for job_id in self.rd_conn.smembers(RUNNING_KEY)
+            ])
+
+    def _needed_machines(self, job):
+        machines = sorted(get_machine_ksl_map().keys())
+        wanted = json.loads(job['machines'])
+        if wanted:
+            machines = [m for m in machines if m in wanted]
+        return machines
+
+    def _update_running_flag(self):
+        # kept for the clients of /api/v1/current/status
+        running = "1" if self.rd_conn.scard(RUNNING_KEY) else "0"
+        self.rd_conn.set("running", running)
+
+    def _schedule(self):
+        # machines wanted by a job waiting ahead in the queue, the jobs
+        # behind it can't take them or a job needing several machines
+        # could wait forever
+        blocked = set()
+        for job_id in self.rd_conn.zrange(QUEUE_KEY, 0, -1):
+            job = self.rd_conn.hgetall(JOB_KEY_TPL.format(job_id))
+            if not job:
+                self.rd_conn.zrem(QUEUE_KEY, job_id)
+                continue
+            machines = self._needed_machines(job)
+            if not machines:
+                log.error("job %s has no machine to run on", job_id)
+                self.rd_conn.zrem(QUEUE_KEY, job_id)
+                self.rd_conn.hset(JOB_KEY_TPL.format(job_id), 'state',
+                                  'failed')
+                continue
+            if blocked.intersection(machines):
+                blocked.update(machines)
+                continue
+            lease = self.leases.acquire(job_id, machines)
+            if lease is None:
+                blocked.update(machines)
+                continue
+            if not self.rd_conn.zrem(QUEUE_KEY, job_id):
+                # taken by another scheduler or cancelled meanwhile
+                lease.release()
+                continue
+            self._start_job(job, lease)
+
+    def _start_job(self, job, lease):
+        job_id = job['id']
+        pipe = self.rd_conn.pipeline()
+        pipe.hmset(
+            JOB_KEY_TPL.format(job_id),
+            dict(
+                state='running',
+                started=time.time(),
+                leased=json.dumps(lease.machines)))
+        pipe.sadd(RUNNING_KEY, job_id)
+        pipe.execute()
+        self._update_running_flag()
+
+        t = Thread(target=self._run_job, args=(job, lease))
+        t.setDaemon(True)
+        t.start()
+
+    def _run_job(self, job, lease):
+        job_id = job['id']
+        log.info("job %s starts on %s", job_id, lease.machines)
+        state = 'done'
+        try:
+            results_logs = ResultsAndLogs(
+                job.get('log_date'), job.get('log_time'))
+            results_logs.img_url = job['img_url']
+            self.rd_conn.hmset(
+                JOB_KEY_TPL.format(job_id),
+                dict(
+                    log_date=results_logs.current_date,
+                    log_time=results_logs.current_time))
+            JobRunner(
+                job['img_url'],
+                self.rd_conn,
+                results_logs,
+                job['target_build'] or None,
+                machines=lease.machines,
+                lease=lease,
+                job_id=job_id).go()
+        except Exception as e:
+            log.exception(e)
+            state = 'failed'
+        finally:
+            lease.release()
+            pipe = self.rd_conn.pipeline()
+            pipe.hmset(
+                JOB_KEY_TPL.format(job_id),
+                dict(state=state, finished=time.time()))
+            pipe.srem(RUNNING_KEY, job_id)
+            pipe.execute()
+            self._update_running_flag()
+            self._wakeup.set()
+
+    def _recover(self):
+        # jobs left running by a previous process go on from their last
+        # step, on the hosts they had if these are still free
+        for job_id in self.rd_conn.smembers(RUNNING_KEY):
+            job = self.rd_conn.hgetall(JOB_KEY_TPL.format(job_id))
+            if not job:
+                self.rd_conn.srem(RUNNING_KEY, job_id)
+                continue
+            self.rd_conn.hincrby(JOB_KEY_TPL.format(job_id), 'resumed', 1)
+            machines = json.loads(job.get('leased') or '[]')
+            lease = self.leases.acquire(job_id, machines) if machines else None
+            if lease is not None:
+                log.info("job %s resumes", job_id)
+                self._start_job(job, lease)
+                continue
+            log.error("job %s lost its hosts, queue it again", job_id)
+            pipe = self.rd_conn.pipeline()
+            pipe.hset(JOB_KEY_TPL.format(job_id), 'state', 'queued')
+            pipe.srem(RUNNING_KEY, job_id)
+            pipe.zadd(QUEUE_KEY,
+                      _score(job['priority'], float(job['created'])), job_id)
+            pipe.execute()
+        self._update_running_flag()
+
+    def _loop(self):
+        while True:
+            self._wakeup.wait(SCHEDULE_INTERVAL)
+            self._wakeup.clear()
+            try:
+                self._schedule()
+            except Exception as e:
+                log.exception(e)
+
+    def start(self):
+        if self._thread:
+            return
+        self._recover()
+        self._thread = Thread(target=self._loop, name="scheduler")
+        self._thread.setDaemon(True)
+        self._thread.start()
+        self._wakeup.set()
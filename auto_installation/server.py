@@ -3,20 +3,31 @@ from __future__ import unicode_literals
 import os
 import base64
 import json
+import zlib
+import mimetypes
+import time
+import gevent
 import utils
 import subprocess as sp
 
-from flask import Flask, request, redirect, abort, jsonify
+from flask import Flask, request, redirect, abort, jsonify, Response, \
+    escape
 from flask_cors import CORS
 
-from .utils import init_redis, setup_funcs, get_lastline_of_file
-from .util_result_index import cache_logs_summary
+from .utils import init_redis, setup_funcs, get_lastline_of_file, \
+    tail_lines, read_log_range, timed, makedirs, ttl_cache
+from .util_result_index import cache_logs_summary, query_log_summary, \
+    summary_version
 from .constants import CURRENT_IP_PORT, BUILDS_SERVER_URL, CB_PROFILE, HOSTS, TEST_LEVEL, PROJECT_ROOT
-from .jobs import job_runner
+from .scheduler import JobScheduler
+from .job_steps import record_install_done
+from .kickstarts import ks_renderer
 from .cobbler import Cobbler
 from .mongodata import MongoQuery
 from .celerytask import RhvhTask
 from .reports import ResultsToPolarion
+from .ssh_pool import ssh_pool
+from . import log_storage
 
 rd_conn = init_redis()
 IP, PORT = CURRENT_IP_PORT
@@ -24,6 +35,12 @@ IP, PORT = CURRENT_IP_PORT
 results_logs = utils.results_logs
 mongo = MongoQuery()
 rt = RhvhTask()
+scheduler = JobScheduler(rd_conn)
+
+# how often followed logs are checked for new lines, in seconds
+LOG_POLL_INTERVAL = 0.5
+# builds and machines change rarely, the launch page may be a bit behind
+MONGO_CACHE_TTL = 60
 
 app = Flask(__name__)
 CORS(app, resources=r'/api/*')
@@ -50,25 +67,33 @@ def start_job():
         rhevh7-ng-36/rhev-hypervisor7-ng-3.6-20160518.0/
         rhev-hypervisor7-ng-3.6-20160518.0.x86_64.liveimg.squashfs
 
+        priority (int): optional, higher runs first, 0 by default
+        machines (list): optional, only run the kickstarts of these machines
+
+    The job is queued and started once its machines are free.
     """
     if request.method == 'POST':
-        if rd_conn.get("running") == "0":
-            rd_conn.set("running", 1)
-            data = request.get_json()
-            img_url = data.get('img', None)
-            target_build = data.get('target_build', None)
-            if img_url:
-                _img_url = img_url.replace('/var/www/builds',
-                                           BUILDS_SERVER_URL)
-
-                results_logs.img_url = _img_url
-
-                t = job_runner(_img_url, rd_conn, results_logs, target_build)
-                t.setDaemon(True)
-                t.start()
-                return redirect('/post_result')
-        else:
-            return redirect('/goaway')
+        data = request.get_json()
+        img_url = data.get('img', None)
+        if not img_url:
+            abort(400)
+        try:
+            priority = int(data.get('priority', 0))
+        except (TypeError, ValueError):
+            abort(400)
+        machines = data.get('machines', None)
+        if machines is not None and (
+                not isinstance(machines, list) or
+                not all(isinstance(m, basestring) and m in HOSTS
+                        for m in machines)):
+            abort(400)
+        _img_url = img_url.replace('/var/www/builds', BUILDS_SERVER_URL)
+        job_id = scheduler.enqueue(
+            _img_url,
+            target_build=data.get('target_build', None),
+            priority=priority,
+            machines=machines)
+        return jsonify(scheduler.job(job_id)), 202
     else:
         abort(406)
 
@@ -85,6 +110,7 @@ def done_job(em1ip, bkr_name, cockpit=None):
     if cockpit is None:
         print("Remote node ip is {}".format(em1ip))
 
+        record_install_done(rd_conn, bkr_name, em1ip)
         rd_conn.publish(bkr_name, 'done,{}'.format(em1ip))
         rd_conn.publish("{0}-cockpit".format(bkr_name), "{0},{1},{2}".format(
             em1ip, 'root', 'redhat'))
@@ -92,6 +118,7 @@ def done_job(em1ip, bkr_name, cockpit=None):
     else:
         print("Remote node ip is {}".format(em1ip))
 
+        record_install_done(rd_conn, bkr_name, em1ip)
         rd_conn.publish(bkr_name, 'done,{}'.format(em1ip))
         rd_conn.publish("{0}-cockpit".format(bkr_name), "{0},{1},{2}".format(
             em1ip, 'root', 'redhat'))
@@ -109,27 +136,142 @@ def done_job(em1ip, bkr_name, cockpit=None):
         return "cockpit done job"
 
 
+def _upload_log_file(stage, log_name):
+    ks_log_path = results_logs.machine_log_path(request.args.get('name'))
+    return os.path.join(ks_log_path, stage, log_name)
+
+
+def _committed_size(log_file):
+    try:
+        return os.path.getsize(log_file)
+    except OSError:
+        return 0
+
+
+def _write_log_chunk(log_file, offset, data):
+    with timed("writing {} bytes to {}".format(len(data), log_file)):
+        makedirs(os.path.dirname(log_file))
+
+        fd = os.open(log_file, os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            os.lseek(fd, offset, os.SEEK_SET)
+            os.write(fd, data)
+            # the data sent is the file content up to here
+            os.ftruncate(fd, offset + len(data))
+        finally:
+            os.close(fd)
+    return offset + len(data)
+
+
+@app.route('/upload/<stage>/<log_name>')
+def get_uploaded_size(stage, log_name):
+    """How much of the log has been committed, anamon resumes from there"""
+    return jsonify(size=_committed_size(_upload_log_file(stage, log_name)))
+
+
 @app.route('/upload/<stage>/<log_name>/<offset>')
 def upload_anaconda_log(stage, log_name, offset):
+    log_file = _upload_log_file(stage, log_name)
+    offset = int(offset)
+    if offset == -1:
+        return jsonify(size=_committed_size(log_file))
+
+    size = _committed_size(log_file)
+    if offset > size:
+        # a hole would be left, let anamon resend from what we have
+        return jsonify(size=size), 409
+
     _data = request.get_json()
     data = base64.decodestring(_data['data'])
-    log_file = os.path.join(results_logs.current_log_path, stage, log_name)
-    log_path = os.path.dirname(log_file)
+    return jsonify(size=_write_log_chunk(log_file, offset, data))
 
-    if not os.path.exists(log_path):
-        os.system("mkdir -p {}".format(log_path))
 
-    if offset != '-1':
-        with open(log_file, 'w') as fp:
-            fp.seek(int(offset))
-            fp.write(data)
-            fp.flush()
-    return "upload done"
+@app.route('/upload/<stage>/<log_name>', methods=['POST'])
+def upload_anaconda_log_raw(stage, log_name):
+    """Raw log bytes in the body, X-Offset tells where they go, they may
+    be zlib compressed with Content-Encoding: deflate
+    """
+    log_file = _upload_log_file(stage, log_name)
+    try:
+        offset = int(request.headers['X-Offset'])
+    except (KeyError, ValueError):
+        return jsonify(error="X-Offset header is required"), 400
+
+    size = _committed_size(log_file)
+    if offset > size:
+        return jsonify(size=size), 409
+
+    data = request.get_data()
+    if request.headers.get('Content-Encoding') == 'deflate':
+        try:
+            data = zlib.decompress(data)
+        except zlib.error:
+            return jsonify(error="corrupted deflate body"), 400
+    length = request.headers.get('X-Length', type=int)
+    if length is not None and length != len(data):
+        return jsonify(size=size), 400
+
+    return jsonify(size=_write_log_chunk(log_file, offset, data))
+
+
+@app.route('/static/auto/<ks_file>')
+def get_auto_ks(ks_file):
+    """Kickstarts are served from memory, the files on disk are a copy"""
+    content = ks_renderer.get(ks_file)
+    if content is None:
+        return app.send_static_file(os.path.join('auto', ks_file))
+    return Response(content, mimetype='text/plain')
+
+
+@app.route('/logs/', defaults={'relpath': ''})
+@app.route('/logs/<path:relpath>')
+def get_log(relpath):
+    """Browse logs/, the LOG_URL of the results, compressed files are
+    served decompressed under their original name
+    """
+    path, _ = log_storage.resolve_log(relpath)
+    if path is None:
+        abort(404)
+    if os.path.isdir(path):
+        if relpath and not relpath.endswith('/'):
+            return redirect(request.path + '/')
+        items = ''.join('<li><a href="{0}">{0}</a></li>'.format(escape(n))
+                        for n in log_storage.list_logs(relpath))
+        return '<html><body><ul>{}</ul></body></html>'.format(items)
+
+    def stream():
+        with log_storage.open_log(relpath) as fp:
+            for chunk in iter(lambda: fp.read(65536), b''):
+                yield chunk
+
+    mimetype = mimetypes.guess_type(relpath)[0] or 'text/plain'
+    return Response(stream(), mimetype=mimetype)
 
 
 # =========== api section =====================================================
 
 
+@app.route('/api/v1/jobs')
+def get_jobs():
+    return jsonify(scheduler.status())
+
+
+@app.route('/api/v1/leases')
+def get_leases():
+    return jsonify(scheduler.leases.occupancy())
+
+
+@app.route('/api/v1/jobs/<job_id>', methods=['GET', 'DELETE'])
+def get_job(job_id):
+    if request.method == 'DELETE':
+        if not scheduler.cancel(job_id):
+            abort(409)
+    job = scheduler.job(job_id)
+    if job is None:
+        abort(404)
+    return jsonify(job)
+
+
 @app.route('/api/v1/current/status')
 def get_current_status():
     ret = {
@@ -143,26 +285,111 @@ def get_current_status():
 
 @app.route('/api/v1/current/build')
 def get_current_build():
-    build_path = results_logs.current_log_path
-    log_file = results_logs.current_log_file
+    build_path = results_logs.latest_log_path
+    log_file = results_logs.latest_log_file
     ret = {'path': build_path, 'log': get_lastline_of_file(log_file)}
     return jsonify(ret)
 
 
+@app.route('/api/v1/current/log')
+def get_current_log():
+    """The last `lines` lines of the current log, or with `offset` the
+    complete lines written since it. With `offset` and `wait` (seconds,
+    at most 60) the request is held until something new comes.
+    """
+    log_file = results_logs.latest_log_file
+    offset = request.args.get('offset', type=int)
+    if offset is None:
+        lines = min(max(request.args.get('lines', 10, type=int), 1), 1000)
+        return jsonify(
+            file=log_file,
+            lines=[l.decode('utf-8', 'replace')
+                   for l in tail_lines(log_file, lines)],
+            offset=os.path.getsize(log_file)
+            if os.path.isfile(log_file) else 0)
+
+    deadline = time.time() + min(request.args.get('wait', 0, type=int), 60)
+    while True:
+        data, new_offset = read_log_range(log_file, offset)
+        if data or time.time() >= deadline or \
+                log_file != results_logs.latest_log_file:
+            break
+        gevent.sleep(LOG_POLL_INTERVAL)
+    return jsonify(
+        file=log_file,
+        data=data.decode('utf-8', 'replace'),
+        offset=new_offset,
+        reset=new_offset < offset)
+
+
+@app.route('/api/v1/current/log/stream')
+def stream_current_log():
+    """Server-Sent Events of the lines appended to the current log, the
+    event id is the offset to resume from with Last-Event-ID
+    """
+    offset = request.headers.get('Last-Event-ID', type=int)
+    if offset is None:
+        offset = request.args.get('offset', 0, type=int)
+
+    def events(offset):
+        log_file = results_logs.latest_log_file
+        idle = 0
+        while True:
+            if log_file != results_logs.latest_log_file:
+                # next kickstart, follow its log from the start
+                log_file = results_logs.latest_log_file
+                offset = 0
+                yield 'event: file\ndata: {}\n\n'.format(log_file)
+            data, offset = read_log_range(log_file, offset)
+            if data:
+                idle = 0
+                lines = ''.join(
+                    'data: {}\n'.format(l)
+                    for l in data.decode('utf-8', 'replace').splitlines())
+                yield 'id: {}\n{}\n'.format(offset, lines)
+            else:
+                idle += LOG_POLL_INTERVAL
+                if idle >= 15:
+                    # keep proxies from closing the idle stream
+                    idle = 0
+                    yield ': keepalive\n\n'
+                gevent.sleep(LOG_POLL_INTERVAL)
+
+    return Response(
+        events(offset),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache'})
+
+
+@app.route('/api/v1/ssh/pool')
+def get_ssh_pool_stats():
+    return jsonify(ssh_pool.stats())
+
+
 @app.route('/api/v1/pxe/profiles')
 def get_pxe_profiles():
     with Cobbler() as cb:
         return jsonify(cb.profiles)
 
 
+@ttl_cache(MONGO_CACHE_TTL)
+def _rhvh_build_names(qname):
+    return mongo.rhvh_build_names(qname)
+
+
+@ttl_cache(MONGO_CACHE_TTL)
+def _bkr_machines():
+    return mongo.machines()
+
+
 @app.route('/api/v1/rhvh_builds/<qname>')
 def get_rhvh_builds(qname):
-    return jsonify(mongo.rhvh_build_names(qname))
+    return jsonify(_rhvh_build_names(qname))
 
 
 @app.route('/api/v1/bkr_machines')
 def get_bkr_machines():
-    return jsonify(mongo.machines())
+    return jsonify(_bkr_machines())
 
 
 @app.route('/api/v1/autojob/lanuch', methods=['POST'])
@@ -209,7 +436,7 @@ def get_last_result():
             "total": -1
         }
     }
-    log_path = os.path.dirname(results_logs.current_log_path)
+    log_path = os.path.dirname(results_logs.latest_log_path)
     result_file = os.path.join(log_path, 'final_results.json')
 
     if not os.path.exists(result_file):
@@ -280,13 +507,40 @@ def git_branchs():
 
 @app.route('/api/v1/logs/summary', methods=['GET'])
 def logs_summary():
-    """_="""
-    res = rd_conn.get('logs_summary')
-    if not res:
+    """Summary of all the runs, or one page of it when queried with
+    date_from/date_to (YYYY-MM-DD), build (prefix), flag
+    (install/upgrade/vdsm), page and limit
+    """
+    if not rd_conn.exists('logs_summary'):
         print("no cache found, generate new cache")
         cache_logs_summary()
-    res = json.loads(rd_conn.get('logs_summary'))
-    return jsonify(res)
+
+    etag = '"%s-%x"' % (summary_version(rd_conn),
+                        hash(request.query_string) & 0xffffffff)
+    if etag in request.headers.get('If-None-Match', ''):
+        return Response(status=304, headers={'ETag': etag})
+
+    if not request.args:
+        # the cached json is served as is, no need to load and dump it
+        resp = Response(rd_conn.get('logs_summary'),
+                        mimetype='application/json')
+    else:
+        try:
+            res = query_log_summary(
+                rd_conn,
+                date_from=request.args.get('date_from'),
+                date_to=request.args.get('date_to'),
+                build_prefix=request.args.get('build'),
+                flag=request.args.get('flag'),
+                page=max(request.args.get('page', 1, type=int), 1),
+                limit=min(max(request.args.get('limit', 20, type=int), 1),
+                          200))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        resp = jsonify(res)
+
+    resp.headers['ETag'] = etag
+    return resp
 
 
 if __name__ == '__main__':
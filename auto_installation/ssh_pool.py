@@ -0,0 +1,220 @@
+"""Persistent ssh connections shared by every checker
+
+One paramiko transport is kept per (user, host), each command runs on a
+new channel of it instead of paying a fresh handshake.
+"""
+import logging
+import os
+import socket
+import stat
+import time
+from threading import Lock
+
+import paramiko
+
+log = logging.getLogger('bender')
+
+CONNECT_TIMEOUT = 10
+KEEPALIVE_INTERVAL = 30
+
+
+class CommandTimeout(Exception):
+    def __init__(self, timeout):
+        super(CommandTimeout, self).__init__(
+            "Command didn't finish within {} seconds".format(timeout))
+        self.timeout = timeout
+
+
+class RemoteResult(str):
+    """Command output, with the attributes of fabric's `run` result"""
+
+    def __new__(cls, output, return_code):
+        ret = str.__new__(cls, output)
+        ret.return_code = return_code
+        ret.succeeded = return_code == 0
+        ret.failed = not ret.succeeded
+        return ret
+
+
+def _shell_wrap(cmd):
+    # keep the same quoting as fabric's run(), checkers rely on it
+    for char in ('"', '$', '`'):
+        cmd = cmd.replace(char, r'\%s' % char)
+    return '/bin/bash -l -c "{}"'.format(cmd)
+
+
+class SSHConnectionPool(object):
+    """One ssh transport per (user, host), checked before every reuse"""
+
+    def __init__(self, connect_timeout=CONNECT_TIMEOUT):
+        self.connect_timeout = connect_timeout
+        self._clients = {}
+        self._host_locks = {}
+        # host -> number of drops, a connection opened across a drop isn't
+        # pooled, the host is going down
+        self._drops = {}
+        self._lock = Lock()
+        self._stats = dict(
+            hits=0, misses=0, reconnects=0, handshakes=0, handshake_time=0.0)
+
+    def _count(self, key, value=1):
+        with self._lock:
+            self._stats[key] += value
+
+    def _host_lock(self, key):
+        with self._lock:
+            return self._host_locks.setdefault(key, Lock())
+
+    @staticmethod
+    def _is_alive(client):
+        transport = client.get_transport()
+        if not transport or not transport.is_active():
+            return False
+        try:
+            transport.send_ignore()
+        except (socket.error, EOFError, paramiko.SSHException):
+            return False
+        return True
+
+    def _handshake(self, host, user, password, attempts):
+        attempt = 0
+        while True:
+            attempt += 1
+            client = paramiko.SSHClient()
+            client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+            start = time.time()
+            try:
+                client.connect(
+                    host,
+                    username=user,
+                    password=password,
+                    timeout=self.connect_timeout,
+                    allow_agent=False,
+                    look_for_keys=False)
+            except paramiko.AuthenticationException:
+                client.close()
+                raise
+            except (socket.error, EOFError, paramiko.SSHException) as e:
+                client.close()
+                if attempt >= attempts:
+                    raise
+                log.info("connect to %s failed (%s), attempt %s of %s", host,
+                         e, attempt, attempts)
+                time.sleep(1)
+                continue
+
+            self._count('handshakes')
+            self._count('handshake_time', time.time() - start)
+            client.get_transport().set_keepalive(KEEPALIVE_INTERVAL)
+            return client
+
+    def connect(self, host, user, password, attempts=1):
+        key = (user, host)
+        # the host lock only keeps the checkers of a host from opening
+        # several connections at once, _clients is guarded by self._lock
+        with self._host_lock(key):
+            with self._lock:
+                client = self._clients.get(key)
+                drops = self._drops.get(host, 0)
+            if client:
+                if self._is_alive(client):
+                    self._count('hits')
+                    return client
+                # most likely the host has been rebooted
+                log.info("ssh connection to %s is dead, reconnecting", host)
+                self._count('reconnects')
+                with self._lock:
+                    if self._clients.get(key) is client:
+                        del self._clients[key]
+                client.close()
+
+            self._count('misses')
+            client = self._handshake(host, user, password, attempts)
+            with self._lock:
+                if self._drops.get(host, 0) == drops:
+                    self._clients[key] = client
+                    return client
+            log.info("%s was dropped while connecting, not pooling", host)
+            return client
+
+    def drop(self, host):
+        """Close every pooled connection to `host`, e.g. before a reboot"""
+        with self._lock:
+            self._drops[host] = self._drops.get(host, 0) + 1
+            keys = [k for k in self._clients if k[1] == host]
+            clients = [self._clients.pop(k) for k in keys]
+        for client in clients:
+            client.close()
+
+    def close_all(self):
+        with self._lock:
+            clients = self._clients.values()
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+    def run(self, host, user, password, cmd, timeout=None, attempts=1):
+        client = self.connect(host, user, password, attempts)
+        chan = client.get_transport().open_session()
+        try:
+            chan.get_pty()
+            chan.exec_command(_shell_wrap(cmd))
+
+            out = []
+            deadline = time.time() + timeout if timeout else None
+            while True:
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise CommandTimeout(timeout)
+                    chan.settimeout(remaining)
+                try:
+                    data = chan.recv(32768)
+                except socket.timeout:
+                    raise CommandTimeout(timeout)
+                if not data:
+                    break
+                out.append(data)
+
+            return RemoteResult(''.join(out).strip(), chan.recv_exit_status())
+        finally:
+            chan.close()
+
+    def get(self, host, user, password, remote_path, local_path, attempts=1):
+        client = self.connect(host, user, password, attempts)
+        if os.path.isdir(local_path):
+            local_path = os.path.join(local_path,
+                                      os.path.basename(remote_path))
+        sftp = client.open_sftp()
+        try:
+            sftp.get(remote_path, local_path)
+        finally:
+            sftp.close()
+        return local_path
+
+    def put(self, host, user, password, local_path, remote_path, attempts=1):
+        client = self.connect(host, user, password, attempts)
+        sftp = client.open_sftp()
+        try:
+            try:
+                if stat.S_ISDIR(sftp.stat(remote_path).st_mode):
+                    remote_path = os.path.join(remote_path,
+                                               os.path.basename(local_path))
+            except IOError:
+                pass
+            sftp.put(local_path, remote_path)
+        finally:
+            sftp.close()
+        return remote_path
+
+    def stats(self):
+        with self._lock:
+            ret = dict(self._stats)
+            ret['connections'] = len(self._clients)
+        if ret['handshakes']:
+            ret['avg_handshake_time'] = ret['handshake_time'] / ret[
+                'handshakes']
+        return ret
+
+
+ssh_pool = SSHConnectionPool()
@@ -31,6 +31,10 @@ import base64
 import shlex
 import httplib
 import json
+import select
+import socket
+import struct
+import zlib
 
 # on older installers (EL 2) we might not have xmlrpclib
 # and can't do logging, however this is more widely
@@ -48,6 +52,32 @@ if not hasattr(shlex, "split"):
     shlex.split = lambda s: s.split(" ")
 
 
+# one keep-alive connection to the server is used for all the uploads
+_conn = None
+
+
+def drop_connection():
+    global _conn
+    if _conn:
+        _conn.close()
+    _conn = None
+
+
+def request(method, url, body=None, headers=None):
+    global _conn
+    for attempt in (0, 1):
+        if _conn is None:
+            _conn = httplib.HTTPConnection(server_ip, server_port)
+        try:
+            _conn.request(method, url, body, headers or {})
+            return _conn.getresponse()
+        except (httplib.HTTPException, socket.error):
+            # the server may have closed the idle connection, retry once
+            drop_connection()
+            if attempt:
+                raise
+
+
 class WatchedFile:
     def __init__(self, fn, alias):
         self.fn = fn
@@ -58,6 +88,7 @@ class WatchedFile:
 
     def reset(self):
         self.where = 0
+        self.committed = None
         self.last_size = 0
         self.lfrag = ''
         self.re_list = {}
@@ -86,47 +117,78 @@ class WatchedFile:
         else:
             return 0
 
-    def _upload_log_data(self, name, alias, sz, offset, data):
-        json_data = json.dumps(dict(data=data))
-        conn = httplib.HTTPConnection(server_ip, server_port)
-
-        conn.request("GET", "/upload/{0}/{1}/{2}".format(stage, alias, offset),
-                     json_data, self._headers)
-        response = conn.getresponse()
+    def _request(self, url, body=None, method="GET", headers=None):
+        if name:
+            url += "?name={0}".format(name)
+        try:
+            response = request(method, url, body, headers or self._headers)
+            ret = response.read()
+            if response.status not in (200, 409):
+                return None
+            return json.loads(ret)['size']
+        except Exception:
+            drop_connection()
+            return None
+
+    def _committed_size(self):
+        url = "/upload/{0}/{1}".format(stage, self.alias)
+        return self._request(url)
 
-        conn.close()
-        # TODO handle response
-        return True
+    def _upload_log_data(self, name, alias, sz, offset, data):
+        """upload data at offset, return the size committed by the server"""
+        if json_upload:
+            json_data = json.dumps(dict(data=base64.encodestring(data)))
+            url = "/upload/{0}/{1}/{2}".format(stage, alias, offset)
+            return self._request(url, json_data)
+
+        headers = {
+            "Content-Type": "application/octet-stream",
+            "X-Offset": str(offset),
+            "X-Length": str(sz),
+        }
+        if compress:
+            data = zlib.compress(data)
+            headers["Content-Encoding"] = "deflate"
+        url = "/upload/{0}/{1}".format(stage, alias)
+        return self._request(url, data, "POST", headers)
 
     def uploadWrapper(self, blocksize=2621445):
-        """upload a file in chunks using the uploadFile call"""
+        """upload the part of the file the server doesn't have yet"""
         retries = 3
-        fo = file(self.fn, "r")
         totalsize = os.path.getsize(self.fn)
-        ofs = 0
-        while True:
-            lap = time.time()
-            contents = fo.read(blocksize)
-            size = len(contents)
-            data = base64.encodestring(contents)
-            if size == 0:
-                offset = -1
-                sz = ofs
-            else:
-                offset = ofs
-                sz = size
-            del contents
-            tries = 0
-            while tries <= retries:
-                debug("upload_log_data('%s')\n" % (offset, ))
-                if self._upload_log_data(name, self.alias, sz, offset, data):
+        if self.committed is None:
+            self.committed = self._committed_size()
+            if self.committed is None:
+                return
+        if totalsize < self.committed:
+            # the file has been truncated or recreated, start it over
+            self.committed = 0
+
+        fo = file(self.fn, "r")
+        try:
+            fo.seek(self.committed)
+            while True:
+                contents = fo.read(blocksize)
+                size = len(contents)
+                if size == 0:
                     break
-                else:
+                offset = self.committed
+                tries = 0
+                while tries <= retries:
+                    debug("upload_log_data('%s')\n" % (offset, ))
+                    committed = self._upload_log_data(name, self.alias, size,
+                                                      offset, contents)
+                    if committed is not None:
+                        break
                     tries = tries + 1
-            if size == 0:
-                break
-            ofs += size
-        fo.close()
+                if committed is None or committed != offset + size:
+                    # ask the server where to resume on the next change
+                    self.committed = None
+                    self.last_size = 0
+                    break
+                self.committed = committed
+        finally:
+            fo.close()
 
     def update(self):
         if not self.exists():
@@ -168,13 +230,123 @@ class MountWatcher:
             self.zero()
 
     def stable(self):
-        self.update()
         if self.line and (time.time() - self.time > 60):
             return 1
         else:
             return 0
 
 
+class PollWatcher:
+    """Fallback when inotify can't be used, wake up every 5 seconds"""
+
+    def watch(self, path):
+        pass
+
+    def wait(self, timeout):
+        time.sleep(5)
+        # None means anything may have changed
+        return None, 1
+
+
+class InotifyWatcher:
+    """Wait on the dirs of the watched files and on the mount table
+
+    The dirs are watched rather than the files, as most of the files don't
+    exist yet when anamon starts.
+    """
+    IN_MODIFY = 0x00000002
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    # events coming within this window are shipped together
+    COALESCE = 0.3
+
+    def __init__(self):
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",
+                                use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.wds = {}
+        self.pending = {}
+        self.poller = select.poll()
+        self.poller.register(self.fd, select.POLLIN)
+        # /proc/mounts turns POLLPRI/POLLERR when the mount table changes
+        self.mounts = open("/proc/mounts")
+        self.poller.register(self.mounts.fileno(),
+                             select.POLLPRI | select.POLLERR)
+
+    def watch(self, path):
+        """watch the dir of path, once it exists"""
+        dname = os.path.dirname(path)
+        if dname in self.wds.values():
+            return
+        if not os.path.isdir(dname):
+            self.pending[dname] = 1
+            return
+        wd = self.libc.inotify_add_watch(self.fd, dname, self.MASK)
+        if wd >= 0:
+            self.wds[wd] = dname
+            if dname in self.pending:
+                del self.pending[dname]
+
+    def _watch_pending(self):
+        # dirs under a new mount point may exist now
+        for dname in self.pending.keys():
+            self.watch(os.path.join(dname, ""))
+
+    def _read_events(self, changed):
+        buf = os.read(self.fd, 65536)
+        pos = 0
+        while pos + 16 <= len(buf):
+            wd, mask, cookie, length = struct.unpack("iIII", buf[pos:pos + 16])
+            fname = buf[pos + 16:pos + 16 + length].rstrip("\0")
+            pos += 16 + length
+            if wd in self.wds and fname:
+                changed[os.path.join(self.wds[wd], fname)] = 1
+
+    def wait(self, timeout):
+        """block until something changes, return (changed paths, mounts
+        changed), changed paths is None on timeout to check everything
+        """
+        changed = {}
+        mounts_changed = 0
+        events = self.poller.poll(timeout * 1000)
+        if not events:
+            self._watch_pending()
+            return None, 1
+        deadline = time.time() + self.COALESCE
+        while events:
+            for fd, event in events:
+                if fd == self.fd:
+                    self._read_events(changed)
+                else:
+                    mounts_changed = 1
+                    self.mounts.seek(0)
+                    self.mounts.read()
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            events = self.poller.poll(remaining * 1000)
+
+        # the dirs of the files waited for, e.g. /mnt/sysimage/root, are
+        # created any time after the mount while other logs keep us busy
+        if self.pending:
+            self._watch_pending()
+        return changed, mounts_changed
+
+
+def get_watcher():
+    try:
+        return InotifyWatcher()
+    except Exception, e:
+        debug("inotify unavailable (%s), polling\n" % e)
+        return PollWatcher()
+
+
 def anamon_loop():
     alog = WatchedFile("/tmp/anaconda.log", "anaconda.log")
     alog.lookfor("step installpackages$")
@@ -237,27 +409,39 @@ def anamon_loop():
         waitlist.extend(package_logs)
         waitlist.extend(bootloader_cfgs)
 
+    watcher = get_watcher()
+    for wf in watchlist + waitlist:
+        watcher.watch(wf.fn)
+
     # Monitor loop
+    changed, mounts_changed = None, 1
     while 1:
-        time.sleep(5)
+        if mounts_changed:
+            sysimage.update()
 
         # Not all log files are available at the start, we'll loop through the
         # waitlist to determine when each file can be added to the watchlist
-        for watch in waitlist:
+        for watch in waitlist[:]:
             if alog.seen("step installpackages$") or (sysimage.stable() and
                                                       watch.exists()):
                 debug("Adding %s to watch list\n" % watch.alias)
                 watchlist.append(watch)
                 waitlist.remove(watch)
+                changed = None
 
         # Send any updates
         for wf in watchlist:
-            wf.update()
+            if changed is None or wf.fn in changed:
+                wf.update()
 
         # If asked to run_once, exit now
         if exit:
             break
 
+        # the mount point has to stay for 60s before waitlist files count,
+        # so don't sleep longer than that while some are waited for
+        changed, mounts_changed = watcher.wait(waitlist and 10 or 60)
+
 # Establish some defaults
 name = ""
 server_ip = ""
@@ -267,48 +451,55 @@ debug = lambda x, **y: None
 watchfiles = []
 exit = False
 stage = ""
-
-# Process command-line args
-n = 0
-while n < len(sys.argv):
-    arg = sys.argv[n]
-    if arg == '--name':
-        n = n + 1
-        name = sys.argv[n]
-    elif arg == '--watchfile':
+compress = True
+json_upload = False
+
+if __name__ == "__main__":
+    # Process command-line args
+    n = 0
+    while n < len(sys.argv):
+        arg = sys.argv[n]
+        if arg == '--name':
+            n = n + 1
+            name = sys.argv[n]
+        elif arg == '--watchfile':
+            n = n + 1
+            watchfiles.extend(shlex.split(sys.argv[n]))
+        elif arg == '--exit':
+            exit = True
+        elif arg == '--server':
+            n = n + 1
+            server_ip = sys.argv[n]
+        elif arg == '--stage':
+            n = n + 1
+            stage = sys.argv[n]
+        elif arg == '--port':
+            n = n + 1
+            server_port = sys.argv[n]
+        elif arg == '--no-compress':
+            compress = False
+        elif arg == '--json-upload':
+            json_upload = True
+        elif arg == '--debug':
+            debug = lambda x, **y: sys.stderr.write(x % y)
+        elif arg == '--fg':
+            daemon = 0
         n = n + 1
-        watchfiles.extend(shlex.split(sys.argv[n]))
-    elif arg == '--exit':
-        exit = True
-    elif arg == '--server':
-        n = n + 1
-        server_ip = sys.argv[n]
-    elif arg == '--stage':
-        n = n + 1
-        stage = sys.argv[n]
-    elif arg == '--port':
-        n = n + 1
-        server_port = sys.argv[n]
-    elif arg == '--debug':
-        debug = lambda x, **y: sys.stderr.write(x % y)
-    elif arg == '--fg':
-        daemon = 0
-    n = n + 1
-
-# Create an xmlrpc session handle
-# session = xmlrpclib.Server("http://%s:%s/cobbler_api" % (server, port))
-
-# Fork and loop
-if daemon:
-    if not os.fork():
-        # Redirect the standard I/O file descriptors to the specified file.
-        DEVNULL = getattr(os, "devnull", "/dev/null")
-        os.open(DEVNULL, os.O_RDWR)  # standard input (0)
-        os.dup2(0, 1)  # Duplicate standard input to standard output (1)
-        os.dup2(0, 2)  # Duplicate standard input to standard error (2)
 
+    # Create an xmlrpc session handle
+    # session = xmlrpclib.Server("http://%s:%s/cobbler_api" % (server, port))
+
+    # Fork and loop
+    if daemon:
+        if not os.fork():
+            # Redirect the standard I/O file descriptors to the specified file.
+            DEVNULL = getattr(os, "devnull", "/dev/null")
+            os.open(DEVNULL, os.O_RDWR)  # standard input (0)
+            os.dup2(0, 1)  # Duplicate standard input to standard output (1)
+            os.dup2(0, 2)  # Duplicate standard input to standard error (2)
+
+            anamon_loop()
+            sys.exit(1)
+        sys.exit(0)
+    else:
         anamon_loop()
-        sys.exit(1)
-    sys.exit(0)
-else:
-    anamon_loop()
@@ -4,37 +4,249 @@ from constants import PROJECT_ROOT
 from utils import init_redis
 
 LOGS_DIR = os.path.join(PROJECT_ROOT, 'logs') + '/'
+FINAL_RESULTS = 'final_results.json'
 
+# run relpath(date/time/build) -> stat signature of its final_results.json
+MANIFEST_KEY = 'logs_index:manifest'
+# run relpath -> [date, time__build, dnames, sum]
+ENTRIES_KEY = 'logs_index:entries'
+SUMMARY_KEY = 'logs_summary'
+# date -> {time__build: [dnames, sum]}, the slices queried by the dashboard
+DATE_KEY_TPL = 'logs_index:date:{}'
+# every date having runs, scored by yyyymmdd
+DATES_KEY = 'logs_index:dates'
+# bumped on every change, used as the ETag of the summary
+VERSION_KEY = 'logs_index:version'
 
-def walk_the_logs():
-    """=+_="""
-    summary = dict()
-    for dpath, dnames, files in os.walk(LOGS_DIR):
-        if 'final_results.json' in files:
-            index = files.index('final_results.json')
-            tmp = dpath.replace(LOGS_DIR, '').split('/')
-            date = tmp[0]
-            time_build = tmp[1] + '__' + tmp[2]
-            try:
-                final_res = json.load(
-                    open(os.path.join(dpath, files[index])))['sum']
-            except ValueError:
-                print("erros exists in file:: " + os.path.join(
-                    dpath, files[index]))
+TEST_FLAGS = {
+    'install': '_Install_',
+    'upgrade': '_Upgrade_',
+    'vdsm': '_Vdsm_',
+}
+
+
+def _signature(run_dir):
+    """Identify the state of a run without reading its results
+
+    The run dir mtime changes when a machine dir is added under it, the
+    results file stat changes when it's rewritten.
+    """
+    try:
+        fst = os.stat(os.path.join(run_dir, FINAL_RESULTS))
+        dst = os.stat(run_dir)
+    except OSError:
+        return None
+    return "%s:%s:%s:%s" % (fst.st_mtime, fst.st_ino, fst.st_size,
+                            dst.st_mtime)
+
+
+def _parse_run(relpath):
+    run_dir = os.path.join(LOGS_DIR, relpath)
+    date, time_, build = relpath.split('/')
+    try:
+        with open(os.path.join(run_dir, FINAL_RESULTS)) as fp:
+            final_res = json.load(fp)['sum']
+    except (IOError, ValueError):
+        print("erros exists in file:: " + os.path.join(run_dir, FINAL_RESULTS))
+        return None
+    dnames = [
+        d for d in os.listdir(run_dir)
+        if os.path.isdir(os.path.join(run_dir, d))
+    ]
+    return [date, time_ + '__' + build, dnames, final_res]
+
+
+def _list_runs():
+    """relpaths of date/time/build dirs, without descending into the logs"""
+    runs = []
+    for date in os.listdir(LOGS_DIR):
+        date_dir = os.path.join(LOGS_DIR, date)
+        if not os.path.isdir(date_dir):
+            continue
+        for time_ in os.listdir(date_dir):
+            time_dir = os.path.join(date_dir, time_)
+            if not os.path.isdir(time_dir):
                 continue
+            for build in os.listdir(time_dir):
+                if os.path.isdir(os.path.join(time_dir, build)):
+                    runs.append('/'.join((date, time_, build)))
+    return runs
+
 
-            if summary.get(date, None):
-                summary[date][time_build] = [dnames, final_res]
-            else:
-                summary[date] = {time_build: [dnames, final_res]}
+def _date_score(date):
+    return int(date.replace('-', ''))
 
+
+def _set_entry(pipe, relpath, entry):
+    date, time_build, dnames, final_res = entry
+    pipe.hset(ENTRIES_KEY, relpath, json.dumps(entry))
+    pipe.hset(
+        DATE_KEY_TPL.format(date), time_build, json.dumps([dnames, final_res]))
+    pipe.zadd(DATES_KEY, _date_score(date), date)
+
+
+def _del_entry(pipe, relpath):
+    date, time_, build = relpath.split('/')
+    pipe.hdel(ENTRIES_KEY, relpath)
+    pipe.hdel(DATE_KEY_TPL.format(date), time_ + '__' + build)
+
+
+def _store_summary(conn):
+    summary = dict()
+    for value in conn.hvals(ENTRIES_KEY):
+        date, time_build, dnames, final_res = json.loads(value)
+        summary.setdefault(date, {})[time_build] = [dnames, final_res]
+    pipe = conn.pipeline()
+    pipe.set(SUMMARY_KEY, json.dumps(summary))
+    pipe.incr(VERSION_KEY)
+    pipe.execute()
     return summary
 
 
+def _patch_summary(conn, relpath, entry):
+    """Put the entry of a single run into the summary, without rebuilding
+    it from every entry; False if there is no summary to patch yet
+    """
+    date, time_, build = relpath.split('/')
+
+    def patch(pipe):
+        blob = pipe.get(SUMMARY_KEY)
+        if blob is None:
+            return False
+        summary = json.loads(blob)
+        runs = summary.setdefault(date, {})
+        if entry is None:
+            runs.pop(time_ + '__' + build, None)
+            if not runs:
+                summary.pop(date)
+        else:
+            runs[entry[1]] = [entry[2], entry[3]]
+        pipe.multi()
+        pipe.set(SUMMARY_KEY, json.dumps(summary))
+        pipe.incr(VERSION_KEY)
+        return True
+
+    return conn.transaction(patch, SUMMARY_KEY, value_from_callable=True)
+
+
+def walk_the_logs(conn=None):
+    """=+_="""
+    conn = conn or init_redis()
+    manifest = conn.hgetall(MANIFEST_KEY)
+    if not conn.exists(DATES_KEY):
+        # index written before the per-date hashes existed, reparse all
+        manifest = {}
+
+    pipe = conn.pipeline()
+    changed = False
+    seen = set()
+    for relpath in _list_runs():
+        sig = _signature(os.path.join(LOGS_DIR, relpath))
+        if sig is None:
+            continue
+        seen.add(relpath)
+        if manifest.get(relpath) == sig:
+            continue
+        changed = True
+        entry = _parse_run(relpath)
+        if entry is None:
+            _del_entry(pipe, relpath)
+        else:
+            _set_entry(pipe, relpath, entry)
+        pipe.hset(MANIFEST_KEY, relpath, sig)
+
+    for relpath in manifest:
+        if relpath not in seen:
+            changed = True
+            pipe.hdel(MANIFEST_KEY, relpath)
+            _del_entry(pipe, relpath)
+    pipe.execute()
+
+    if changed or not conn.exists(SUMMARY_KEY):
+        return _store_summary(conn)
+    return json.loads(conn.get(SUMMARY_KEY))
+
+
+def upsert_log_summary(run_dir, conn=None):
+    """Index the single run under `run_dir` and refresh the summary"""
+    conn = conn or init_redis()
+    relpath = os.path.relpath(run_dir, LOGS_DIR)
+    sig = _signature(run_dir)
+    if sig is None:
+        return
+    entry = _parse_run(relpath)
+    pipe = conn.pipeline()
+    if entry is None:
+        _del_entry(pipe, relpath)
+    else:
+        _set_entry(pipe, relpath, entry)
+    pipe.hset(MANIFEST_KEY, relpath, sig)
+    pipe.execute()
+    # called after every kickstart of a run, keep it cheap
+    if not _patch_summary(conn, relpath, entry):
+        _store_summary(conn)
+
+
+def summary_version(conn):
+    return conn.get(VERSION_KEY) or '0'
+
+
+def _match_run(time_build, final_res, build_prefix, flag):
+    if build_prefix and not time_build.split('__', 1)[-1].startswith(
+            build_prefix):
+        return False
+    if flag:
+        title = (final_res or {}).get('title') or ''
+        if TEST_FLAGS[flag] not in title:
+            return False
+    return True
+
+
+def query_log_summary(conn,
+                      date_from=None,
+                      date_to=None,
+                      build_prefix=None,
+                      flag=None,
+                      page=1,
+                      limit=20):
+    """One page of runs, newest first, in the shape of the full summary
+
+    Only the per-date hashes down to the requested page are read.
+    """
+    if flag and flag not in TEST_FLAGS:
+        raise ValueError("flag should be one of %s" % ', '.join(TEST_FLAGS))
+    low = _date_score(date_from) if date_from else '-inf'
+    high = _date_score(date_to) if date_to else '+inf'
+    dates = conn.zrevrangebyscore(DATES_KEY, high, low)
+
+    start = (page - 1) * limit
+    end = start + limit
+    matched = 0
+    summary = dict()
+    for date in dates:
+        runs = conn.hgetall(DATE_KEY_TPL.format(date))
+        for time_build in sorted(runs, reverse=True):
+            dnames, final_res = json.loads(runs[time_build])
+            if not _match_run(time_build, final_res, build_prefix, flag):
+                continue
+            if start <= matched < end:
+                summary.setdefault(date, {})[time_build] = [dnames, final_res]
+            matched += 1
+            if matched > end:
+                break
+        if matched > end:
+            break
+
+    return {
+        'page': page,
+        'limit': limit,
+        'has_more': matched > end,
+        'summary': summary
+    }
+
+
 def cache_logs_summary():
-    conn = init_redis()
-    logs = json.dumps(walk_the_logs())
-    conn.set("logs_summary", logs)
+    walk_the_logs()
 
 
 if __name__ == "__main__":
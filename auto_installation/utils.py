@@ -1,9 +1,15 @@
 import os
+import copy
+import errno
+import functools
+import shutil
 import logging.config
+import threading
+import attr
 import yaml
 import redis
 import time
-import subprocess as sp
+from contextlib import contextmanager
 from constants import PROJECT_ROOT, \
     TEST_LEVEL, \
     ANACONDA_TIER1, ANACONDA_TIER2, KS_TIER1, KS_TIER2, \
@@ -17,6 +23,9 @@ from const_vdsm import VDSM_TIER_TESTCASE_MAP
 
 log = logging.getLogger('bender')
 
+# logging lane bound to the current thread, shared by every ResultsAndLogs
+_lane_local = threading.local()
+
 
 class ReserveUserWrongException(Exception):
     def __init__(self, message):
@@ -26,20 +35,54 @@ User::<{user_name_r}>, but currently reserved by User::<{user_name_w}>'''
                              .format(**message))
 
 
+@attr.s
+class LogLane(object):
+    """Logging context of one machine when several machines run at once"""
+    name = attr.ib()
+    logger_name = attr.ib(default="results")
+    log_path = attr.ib(default="/tmp/logs")
+    log_file = attr.ib(default="/tmp/logs")
+    handler = attr.ib(default=None)
+
+
+class LaneFilter(logging.Filter):
+    """Only pass records emitted from threads bound to the given lane"""
+
+    def __init__(self, lane_local, lane):
+        logging.Filter.__init__(self)
+        self.lane_local = lane_local
+        self.lane = lane
+
+    def filter(self, record):
+        return getattr(self.lane_local, 'lane', None) is self.lane
+
+
 class ResultsAndLogs(object):
     """This class will prepare logs directory structure
     """
-
-    def __init__(self):
+    # shared by the ResultsAndLogs of all the jobs, as the logging config
+    # is global and uploads only know the machine they come from, the api
+    # shows the latest log of any job
+    _lane_lock = threading.Lock()
+    _base_configured = False
+    _machine_log_paths = {}
+    _latest_log_path = "/tmp/logs"
+    _latest_log_file = "/tmp/logs"
+
+    def __init__(self, current_date=None, current_time=None):
+        # a resumed job passes the date and time of its first run, to go on
+        # logging into the same dirs
         self._logs_root_dir = os.path.join(PROJECT_ROOT, 'logs')
         self._img_url = None
         self.logger_conf = os.path.join(PROJECT_ROOT, 'logger.yml')
         self._logger_name = "results"
         self.logger_dict = self.conf_to_dict()
+        self._current_date = current_date or self.get_current_date()
+        self._current_time = current_time or self.get_current_time()
+        # the log of this job, out of the lanes
         self._current_log_path = "/tmp/logs"
         self._current_log_file = "/tmp/logs"
-        self._current_date = self.get_current_date()
-        self._current_time = self.get_current_time()
+        self._lane_local = _lane_local
 
     @property
     def img_url(self):
@@ -51,20 +94,76 @@ class ResultsAndLogs(object):
 
     @property
     def logger_name(self):
+        if self.lane:
+            return self.lane.logger_name
         return self._logger_name
 
     @logger_name.setter
     def logger_name(self, val):
-        self._logger_name = val
+        if self.lane:
+            self.lane.logger_name = val
+        else:
+            self._logger_name = val
 
     @property
     def current_log_path(self):
+        if self.lane:
+            return self.lane.log_path
         return self._current_log_path
 
     @property
     def current_log_file(self):
+        if self.lane:
+            return self.lane.log_file
         return self._current_log_file
 
+    @property
+    def latest_log_path(self):
+        return ResultsAndLogs._latest_log_path
+
+    @property
+    def latest_log_file(self):
+        return ResultsAndLogs._latest_log_file
+
+    @property
+    def current_date(self):
+        return self._current_date
+
+    @property
+    def current_time(self):
+        return self._current_time
+
+    @property
+    def build_log_path(self):
+        return os.path.join(self._logs_root_dir, self._current_date,
+                            self._current_time, self.parse_img_url())
+
+    @property
+    def lane(self):
+        return getattr(self._lane_local, 'lane', None)
+
+    def start_lane(self, name):
+        """Bind a new logging lane named `name` to the current thread"""
+        lane = LogLane(name, logger_name=self._logger_name)
+        self.bind_lane(lane)
+        return lane
+
+    def bind_lane(self, lane):
+        """Make the current thread log into an existing lane"""
+        self._lane_local.lane = lane
+
+    def stop_lane(self):
+        lane = self.lane
+        if lane and lane.handler:
+            logging.getLogger('bender').removeHandler(lane.handler)
+            lane.handler.close()
+            lane.handler = None
+        self._lane_local.lane = None
+
+    def machine_log_path(self, name):
+        """Log path of the kickstart currently running on machine `name`"""
+        return self._machine_log_paths.get(name, self._latest_log_path)
+
     def get_current_date(self):
         return time.strftime("%Y-%m-%d", time.localtime())
 
@@ -83,29 +182,123 @@ class ResultsAndLogs(object):
                                 self._current_time,
                                 self.parse_img_url(), ks_name,
                                 self.logger_name)
-        if not os.path.exists(log_file):
-            os.system("mkdir -p {0}".format(os.path.dirname(log_file)))
+        makedirs(os.path.dirname(log_file))
+
+        ResultsAndLogs._latest_log_path = os.path.dirname(log_file)
+        ResultsAndLogs._latest_log_file = log_file
+
+        lane = self.lane
+        if lane:
+            lane.log_path = os.path.dirname(log_file)
+            lane.log_file = log_file
+            self._machine_log_paths[lane.name] = lane.log_path
+            self._set_lane_handler(lane)
+            return
 
         self._current_log_path = os.path.dirname(log_file)
         self._current_log_file = log_file
-
         self.logger_dict['logging']['handlers']['logfile'][
             'filename'] = log_file
 
         logging.config.dictConfig(self.logger_dict['logging'])
+        ResultsAndLogs._base_configured = False
+
+    def _set_lane_handler(self, lane):
+        logger = logging.getLogger('bender')
+        with self._lane_lock:
+            if not self._base_configured:
+                # console only, every lane adds its own file handler
+                conf = copy.deepcopy(self.logger_dict['logging'])
+                conf['handlers'].pop('logfile')
+                conf['loggers']['bender']['handlers'] = ['console']
+                logging.config.dictConfig(conf)
+                ResultsAndLogs._base_configured = True
+
+            if lane.handler:
+                logger.removeHandler(lane.handler)
+                lane.handler.close()
+
+            fmt = self.logger_dict['logging']['formatters']['simpleFormatter']
+            handler = logging.FileHandler(lane.log_file)
+            handler.setLevel(logging.DEBUG)
+            handler.setFormatter(
+                logging.Formatter(fmt['format'], fmt['datefmt']))
+            handler.addFilter(LaneFilter(self._lane_local, lane))
+            logger.addHandler(handler)
+            lane.handler = handler
 
     def del_existing_logs(self, ks_name=''):
         log_file = os.path.join(PROJECT_ROOT, 'logs',
                                 self._current_date,
                                 self._current_time,
                                 self.parse_img_url(), ks_name)
-        if os.path.exists(log_file):
-            os.system('rm -rf {}/*'.format(log_file))
+        with timed("clearing {}".format(log_file)):
+            clear_dir(log_file)
 
 
 results_logs = ResultsAndLogs()
 
 
+@contextmanager
+def timed(what):
+    start = time.time()
+    try:
+        yield
+    finally:
+        log.debug("%s took %.3fs", what, time.time() - start)
+
+
+def ttl_cache(ttl):
+    """Cache the results of a function by its positional args for `ttl`
+    seconds, `func.cache_clear()` drops them all
+    """
+
+    def decorator(func):
+        cache = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            now = time.time()
+            with lock:
+                hit = cache.get(args)
+            if hit and hit[0] > now:
+                return hit[1]
+            ret = func(*args)
+            with lock:
+                cache[args] = (now + ttl, ret)
+            return ret
+
+        wrapper.cache_clear = cache.clear
+        return wrapper
+
+    return decorator
+
+
+def makedirs(path):
+    """mkdir -p"""
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def clear_dir(path):
+    """rm -rf path/*"""
+    if not os.path.isdir(path):
+        return
+    for name in os.listdir(path):
+        child = os.path.join(path, name)
+        try:
+            if os.path.isdir(child) and not os.path.islink(child):
+                shutil.rmtree(child)
+            else:
+                os.unlink(child)
+        except OSError as e:
+            log.error("failed to remove %s: %s", child, e)
+
+
 def init_redis():
     pool = redis.ConnectionPool(
         host='localhost', port=6379, db=0, password='redhat')
@@ -131,99 +324,172 @@ def init_kickstart_file(fn, args):
 
 
 def setup_funcs(redis_conn):
-    print("flush all keys from current database")
-    redis_conn.flushdb()
+    # the job queue and the logs index are kept across restarts, jobs left
+    # running are cleaned up by the scheduler
     print("set key 'running' value to '0'")
-    redis_conn.set('running', 0, nx=True)
+    redis_conn.set('running', 0)
 
 
-def get_testcase_map():
-    # get testcase map
-    testcase_map = {}
-    if TEST_LEVEL & ANACONDA_TIER1:
-        testcase_map.update(ANACONDA_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & ANACONDA_TIER2:
-        testcase_map.update(ANACONDA_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER1:
-        testcase_map.update(KS_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & KS_TIER2:
-        testcase_map.update(KS_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & DEBUG_TIER:
-        testcase_map.update(DEBUG_TIER_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER1:
-        testcase_map.update(UPGRADE_TIER1_TESTCASE_MAP)
-    if TEST_LEVEL & UPGRADE_TIER2:
-        testcase_map.update(UPGRADE_TIER2_TESTCASE_MAP)
-    if TEST_LEVEL & VDSM_TIER:
-        testcase_map.update(VDSM_TIER_TESTCASE_MAP)
-
-    if not testcase_map:
-        raise ValueError('Invaild TEST_LEVEL')
-
-    return testcase_map
+TIER_TESTCASE_MAPS = (
+    (ANACONDA_TIER1, ANACONDA_TIER1_TESTCASE_MAP),
+    (ANACONDA_TIER2, ANACONDA_TIER2_TESTCASE_MAP),
+    (KS_TIER1, KS_TIER1_TESTCASE_MAP),
+    (KS_TIER2, KS_TIER2_TESTCASE_MAP),
+    (DEBUG_TIER, DEBUG_TIER_TESTCASE_MAP),
+    (UPGRADE_TIER1, UPGRADE_TIER1_TESTCASE_MAP),
+    (UPGRADE_TIER2, UPGRADE_TIER2_TESTCASE_MAP),
+    (VDSM_TIER, VDSM_TIER_TESTCASE_MAP),
+)
 
 
-def get_machine_ksl_map():
-    machine_ksl_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        flag = False
-        if machine in machine_ksl_map:
-            if ks not in machine_ksl_map.get(machine):
-                flag = True
-        else:
-            machine_ksl_map[machine] = []
-            flag = True
-
-        if flag:
-            if ks in KS_PRESSURE_MAP:
-                ks_repeat_ls = [ks] * int(KS_PRESSURE_MAP.get(ks))
-                machine_ksl_map[machine].extend(ks_repeat_ls)
-            else:
-                machine_ksl_map[machine].append(ks)
-    for k in machine_ksl_map:
-        machine_ksl_map[k].sort()
-
-    return machine_ksl_map
+class TestcaseIndex(object):
+    """All the lookups over the testcase maps enabled by one test level
 
+    Built once per test level, the maps are never modified afterwards and
+    the accessors hand out copies.
+    """
 
-def get_ks_machine_map():
-    ks_mashine_map = {}
-    testcase_map = get_testcase_map()
-    for value in testcase_map.itervalues():
-        ks = value[0]
-        machine = value[1]
-        if ks in ks_mashine_map:
-            if machine != ks_mashine_map.get(ks):
+    def __init__(self, test_level):
+        self._test_level = test_level
+
+        testcase_map = {}
+        for tier, tier_map in TIER_TESTCASE_MAPS:
+            if test_level & tier:
+                testcase_map.update(tier_map)
+        if not testcase_map:
+            raise ValueError('Invaild TEST_LEVEL')
+
+        ks_machine_map = {}
+        ks_mc_checkpoint_map = {}
+        checkpoint_cases_map = {}
+        for case, (ks, machine, checkpoint) in testcase_map.items():
+            if ks_machine_map.setdefault(ks, machine) != machine:
                 raise ValueError(
                     'One kickstart file %s cannot be run on two machines.' % ks)
-        else:
-            ks_mashine_map[ks] = machine
+            ks_mc_checkpoint_map.setdefault((ks, machine), {}).setdefault(
+                checkpoint, []).append(case)
+            checkpoint_cases_map.setdefault(checkpoint, []).append(case)
+
+        machine_ksl_map = {}
+        for ks, machine in ks_machine_map.items():
+            repeat = int(KS_PRESSURE_MAP.get(ks, 1))
+            machine_ksl_map.setdefault(machine, []).extend([ks] * repeat)
+        for ksl in machine_ksl_map.values():
+            ksl.sort()
+
+        self._testcase_map = testcase_map
+        self._ks_machine_map = ks_machine_map
+        self._machine_ksl_map = machine_ksl_map
+        self._ks_mc_checkpoint_map = ks_mc_checkpoint_map
+        self._checkpoint_cases_map = checkpoint_cases_map
 
-    return ks_mashine_map
+    @property
+    def test_level(self):
+        return self._test_level
 
+    @property
+    def testcase_map(self):
+        return dict(self._testcase_map)
 
-def get_checkpoint_cases_map(ks, mc):
-    # get testcase map
-    testcase_map = get_testcase_map()
-
-    checkpoint_cases_map = {}
-    for key, value in testcase_map.items():
-        if set((ks, mc)) < set(value):
-            checkpoint = value[2]
-            if checkpoint in checkpoint_cases_map:
-                checkpoint_cases_map[checkpoint].append(key)
-            else:
-                checkpoint_cases_map[checkpoint] = []
-                checkpoint_cases_map[checkpoint].append(key)
+    @property
+    def ks_machine_map(self):
+        return dict(self._ks_machine_map)
+
+    @property
+    def machine_ksl_map(self):
+        return dict((k, list(v)) for k, v in self._machine_ksl_map.items())
+
+    def checkpoint_cases_map(self, ks, machine):
+        """{checkpoint: [case, ...]} of kickstart `ks` on `machine`"""
+        cks = self._ks_mc_checkpoint_map.get((ks, machine), {})
+        return dict((k, list(v)) for k, v in cks.items())
+
+    def cases_of_checkpoint(self, checkpoint):
+        return list(self._checkpoint_cases_map.get(checkpoint, []))
+
+    def testcase(self, case):
+        """(ks, machine, checkpoint) of `case`, None if it isn't enabled"""
+        return self._testcase_map.get(case)
+
+
+_testcase_index = None
+_testcase_index_lock = threading.Lock()
 
-    return checkpoint_cases_map
+
+def get_testcase_index():
+    """The shared TestcaseIndex of TEST_LEVEL, built on first use
+
+    Like the rest of constants.json, the test level is read once at import,
+    kickstarts and the api show the same TEST_LEVEL the index is built of.
+    """
+    global _testcase_index
+
+    with _testcase_index_lock:
+        if _testcase_index is None:
+            _testcase_index = TestcaseIndex(TEST_LEVEL)
+        return _testcase_index
+
+
+def get_testcase_map():
+    return get_testcase_index().testcase_map
+
+
+def get_machine_ksl_map():
+    return get_testcase_index().machine_ksl_map
+
+
+def get_ks_machine_map():
+    return get_testcase_index().ks_machine_map
+
+
+def get_checkpoint_cases_map(ks, mc):
+    return get_testcase_index().checkpoint_cases_map(ks, mc)
+
+
+def tail_lines(file_path, num=1, blocksize=4096):
+    """The last `num` lines of a file, read backwards from its end"""
+    try:
+        fp = open(file_path, 'rb')
+    except IOError:
+        return []
+    with fp:
+        fp.seek(0, os.SEEK_END)
+        pos = fp.tell()
+        data = ''
+        # one more newline than lines wanted, the last line may end with one
+        while pos > 0 and data.count('\n') <= num:
+            step = min(blocksize, pos)
+            pos -= step
+            fp.seek(pos)
+            data = fp.read(step) + data
+    return data.splitlines(True)[-num:]
+
+
+def read_log_range(file_path, offset, max_size=1024 * 1024):
+    """Complete lines written since `offset`, and the offset after them
+
+    The offset falls back to 0 when the file is shorter than it, i.e. it
+    has been recreated.
+    """
+    try:
+        fp = open(file_path, 'rb')
+    except IOError:
+        return '', 0
+    with fp:
+        fp.seek(0, os.SEEK_END)
+        if offset > fp.tell():
+            offset = 0
+        fp.seek(offset)
+        data = fp.read(max_size)
+    end = data.rfind('\n') + 1
+    if not end and len(data) == max_size:
+        # a single line longer than max_size, don't get stuck on it
+        end = max_size
+    return data[:end], offset + end
 
 
 def get_lastline_of_file(file_path):
-    return sp.check_output(['tail', '-1', file_path])
+    return ''.join(tail_lines(file_path, 1))
 
 
 if __name__ == '__main__':
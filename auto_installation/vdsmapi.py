@@ -1,7 +1,6 @@
-import base64
 import time
-import requests
-import shutil
+from rhvm_client import get_rhvm_client
+from rhvm_events import mentions
 import re
 
 
@@ -12,20 +11,8 @@ class RhevmAction:
     RhevmAction("rhevm-40-1.englab.nay.redhat.com").add_new_host("10.66.8.217", "autotest01", "redhat")
     """
 
-    auth_format = "{user}@{domain}:{password}"
     api_url = "https://{rhevm_fqdn}/ovirt-engine/api/{item}"
 
-    headers = {
-        "Prefer": "persistent-auth",
-        "Accept": "application/json",
-        "Content-type": "application/xml"
-    }
-
-    cert_url = ("https://{rhevm_fqdn}/ovirt-engine/services"
-                "/pki-resource?resource=ca-certificate&format=X509-PEM-CA")
-
-    rhevm_cert = "/tmp/rhevm.cert"
-
     def __init__(self,
                  rhevm_fqdn,
                  user="admin",
@@ -36,27 +23,17 @@ class RhevmAction:
         self.user = user
         self.password = password
         self.domain = domain
-        self.token = base64.b64encode(
-            self.auth_format.format(
-                user=self.user, domain=self.domain, password=self.password))
-        self.headers.update({
-            "Authorization": "Basic {token}".format(token=self.token)
-        })
-        self._get_rhevm_cert_file()
-        self.req = requests.Session()
-
-    def _get_rhevm_cert_file(self):
-        r = requests.get(self.cert_url.format(rhevm_fqdn=self.rhevm_fqdn),
-                         stream=True,
-                         verify=False)
-
-        if r.status_code == 200:
-            with open(self.rhevm_cert, 'wb') as f:
-                r.raw.decode_content = True
-                shutil.copyfileobj(r.raw, f)
-        else:
-            raise RuntimeError("Can not get the cert file from %s" %
-                               self.rhevm_fqdn)
+        # shared by every RhevmAction of the engine
+        self.req = get_rhvm_client(rhevm_fqdn, user, password, domain)
+        self.headers = self.req.headers
+        self.rhevm_cert = self.req.cert
+
+    def wait_for(self, check, timeout, *names):
+        """Wait until check() passes, checking again as soon as an event
+        mentioning one of names comes
+        """
+        match = mentions(*names) if names else None
+        return self.req.events.wait(check, timeout, match=match)
 
     ###################################
     # Datacenter related functions
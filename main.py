@@ -1,7 +1,9 @@
 from auto_installation import app, setup_funcs, rd_conn
+from auto_installation.server import scheduler
 from gevent.pywsgi import WSGIServer
 
 if __name__ == '__main__':
     setup_funcs(rd_conn)
+    scheduler.start()
     srv = WSGIServer(('', 5000), app)
     srv.serve_forever()
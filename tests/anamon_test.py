@@ -0,0 +1,33 @@
+import os
+import imp
+import shutil
+import tempfile
+from nose.tools import ok_
+anamon = imp.load_source(
+    "anamon",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                 "../auto_installation/static/anamon.py"))
+
+
+def test_watch_dir_created_while_busy():
+    tmp = tempfile.mkdtemp()
+    try:
+        busy = os.path.join(tmp, "syslog")
+        late = os.path.join(tmp, "root", "install.log")
+        watcher = anamon.InotifyWatcher()
+        watcher.watch(busy)
+        watcher.watch(late)
+        ok_(os.path.dirname(late) in watcher.pending)
+
+        # the dir shows up while another log keeps the watcher awake
+        os.mkdir(os.path.dirname(late))
+        open(busy, "a").write("noise\n")
+        changed, _ = watcher.wait(5)
+        ok_(busy in changed)
+        ok_(not watcher.pending)
+
+        open(late, "a").write("installing\n")
+        changed, _ = watcher.wait(5)
+        ok_(late in changed)
+    finally:
+        shutil.rmtree(tmp)
@@ -0,0 +1,30 @@
+from nose.tools import ok_, eq_
+from auto_installation.check_comm import gen_batch_script, parse_batch_output
+
+
+def test_gen_batch_script_escape_quote():
+    script = gen_batch_script(["echo 'a'"], 'abc', 10)
+    ok_("timeout --foreground 10 /bin/bash -c 'echo '\\''a'\\'''" in script)
+    ok_("echo __ZB_abc_END_0_$?__" in script)
+
+
+def test_parse_batch_output():
+    output = ("__ZB_abc_BEGIN_0__\r\n"
+              "line1\r\nline2\r\n"
+              "__ZB_abc_END_0_0__\r\n"
+              "__ZB_abc_BEGIN_1__\r\n"
+              "__ZB_abc_END_1_1__\r\n"
+              "__ZB_abc_BEGIN_2__\r\n"
+              "killed\r\n"
+              "__ZB_abc_END_2_124__")
+    rets = parse_batch_output(output, 'abc', 3)
+    eq_(rets[0], "line1\r\nline2")
+    ok_(rets[0].succeeded)
+    eq_(rets[1], "")
+    ok_(rets[1].failed)
+    eq_(rets[2].return_code, 124)
+
+
+def test_parse_batch_output_ignore_other_token():
+    output = "__ZB_xyz_BEGIN_0__\r\nfoo\r\n__ZB_xyz_END_0_0__"
+    eq_(parse_batch_output(output, 'abc', 1), {})
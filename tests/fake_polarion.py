@@ -0,0 +1,79 @@
+"""In-memory polarion backend, to run the exporter offline
+
+    python tests/fake_polarion.py [records]
+
+compares the old one record per second upload to the exporter, against a
+server throttling above `max_rate` calls per second.
+"""
+import os
+import sys
+import time
+from threading import Lock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../auto_installation"))
+from polarion_export import PolarionExporter, TransientError, make_records
+
+
+class FakePolarionBackend(object):
+    def __init__(self, latency=0.05, max_rate=None, fail_every=0):
+        # every call takes `latency`, calls above `max_rate` per second are
+        # throttled and every `fail_every`th call times out
+        self.latency = latency
+        self.max_rate = max_rate
+        self.fail_every = fail_every
+        self.runs = {}
+        self.calls = 0
+        self.failures = 0
+        self._last_call = 0
+        self._lock = Lock()
+
+    def _request(self):
+        with self._lock:
+            self.calls += 1
+            now = time.time()
+            too_fast = (self.max_rate and
+                        now - self._last_call < 1.0 / self.max_rate)
+            self._last_call = now
+            if too_fast or (self.fail_every and
+                            self.calls % self.fail_every == 0):
+                self.failures += 1
+                raise TransientError("call {} throttled".format(self.calls))
+        time.sleep(self.latency)
+
+    def open_run(self, test_run_id):
+        self._request()
+        return test_run_id
+
+    def add_record(self, run, record):
+        self._request()
+        with self._lock:
+            self.runs.setdefault(run, []).append(record)
+
+    def records(self, test_run_id):
+        return self.runs.get(test_run_id, [])
+
+
+def _bench(num):
+    results = dict(("RHEVM-%05d" % i, 'passed' if i % 7 else 'failed')
+                   for i in range(num))
+    records = make_records(results)
+
+    backend = FakePolarionBackend(max_rate=5)
+    start = time.time()
+    for r in records:
+        backend.add_record('per-record', r)
+        time.sleep(1)
+    print "per record: %s calls in %.1fs" % (backend.calls,
+                                              time.time() - start)
+
+    backend = FakePolarionBackend(max_rate=5, fail_every=4)
+    start = time.time()
+    PolarionExporter(backend).submit('exporter', records).get()
+    print "exporter: %s calls, %s failed, %s records in %.1fs" % (
+        backend.calls, backend.failures, len(backend.records('exporter')),
+        time.time() - start)
+
+
+if __name__ == '__main__':
+    _bench(int(sys.argv[1]) if len(sys.argv) > 1 else 100)
@@ -0,0 +1,69 @@
+import os
+import sys
+from nose.tools import ok_, eq_, raises
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "../auto_installation"))
+from polarion_export import PolarionExporter, TokenBucket, TransientError, \
+    make_records
+from fake_polarion import FakePolarionBackend
+
+
+def _records(num):
+    return make_records(
+        dict(("RHEVM-%05d" % i, 'passed') for i in range(num)))
+
+
+def _exporter(backend, **kwargs):
+    return PolarionExporter(
+        backend,
+        bucket=TokenBucket(rate=100, burst=100, max_rate=1000),
+        **kwargs)
+
+
+def test_make_records_skips_blocked():
+    records = make_records({'RHEVM-1': 'passed', 'RHEVM-2': 'blocked'})
+    eq_([r['test_case_id'] for r in records], ['RHEVM-1'])
+
+
+def test_export_adds_every_record():
+    backend = FakePolarionBackend(latency=0)
+    eq_(_exporter(backend).export('tr', _records(120)), 120)
+    # opening the test run, then a call per record
+    eq_(backend.calls, 121)
+    eq_(len(backend.records('tr')), 120)
+
+
+def test_export_retries_transient_failures():
+    backend = FakePolarionBackend(latency=0, fail_every=5)
+    exporter = _exporter(backend)
+    exporter.export('tr', _records(30))
+    eq_(len(backend.records('tr')), 30)
+    ok_(backend.failures > 0)
+    ok_(exporter.bucket.rate < 100)
+
+
+@raises(TransientError)
+def test_export_gives_up():
+    backend = FakePolarionBackend(latency=0, fail_every=1)
+    _exporter(backend, retries=2).export('tr', _records(1))
+
+
+def test_submit_is_async():
+    backend = FakePolarionBackend(latency=0.2)
+    exporter = _exporter(backend)
+    result = exporter.submit('tr', _records(5))
+    ok_(not result.ready())
+    ok_(exporter.wait('tr', 5))
+    eq_(result.get(), 5)
+    eq_(len(backend.records('tr')), 5)
+    ok_('tr' not in exporter._pending)
+
+
+def test_wait_reports_failed_exports():
+    backend = FakePolarionBackend(latency=0, fail_every=1)
+    exporter = _exporter(backend, retries=0)
+    exporter.submit('tr', _records(1))
+    ok_(not exporter.wait('tr', 5))
+    # failed exports are reported again
+    ok_(not exporter.wait('tr', 5))
+    ok_(exporter.wait('other', 5))